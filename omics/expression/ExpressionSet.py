@@ -11,11 +11,59 @@ Reference:
 Todo:
   * Add tests.
 """
+import numpy as np
 import pandas as pd
+from collections import OrderedDict, namedtuple
 
 __author__ = "Cho-Yi Chen"
 __version__ = "2016.10.16"
 
+def _same_index(a, b):
+    """Test if two indexes have the same labels in the same order.
+
+    The same Index object short-circuits, and so do indexes of different lengths.
+    Otherwise the labels are compared once (Index.equals): indexes found equal
+    share a token, cached on the (immutable) Index objects, so later checks
+    between any of them are free. A MultiIndex can be changed in place
+    (e.g., set_levels(inplace=True)), so it is always compared in full.
+    """
+    if a is b:
+        return True
+    if len(a) != len(b):
+        return False
+    if isinstance(a, pd.MultiIndex) or isinstance(b, pd.MultiIndex):
+        return a.equals(b)
+    ta, tb = getattr(a, '_omics_aligned', None), getattr(b, '_omics_aligned', None)
+    if ta is not None and ta is tb:
+        return True
+    if not a.equals(b):
+        return False
+    a._omics_aligned = b._omics_aligned = ta or tb or object()
+    return True
+
+_Derived = namedtuple('_Derived', ['func', 'source'])  # an assay computed from another assay
+
+class _DerivedArray(object):
+    """A derived assay of an eSet as a 2-D array-like, computed (and cached) by that eSet on first read.
+
+    Subsets refer to it, so a derived assay is always computed on the full assays of
+    the eSet that defines it; func need not be elementwise (e.g., a per-sample normalization).
+    """
+    def __init__(self, eSet, name):
+        self.eSet = eSet
+        self.name = name
+
+    @property
+    def shape(self):
+        return len(self.eSet.features), len(self.eSet.samples)
+
+    @property
+    def dtype(self):
+        return self[:, :].dtype
+
+    def __getitem__(self, key):
+        return self.eSet.assay(self.name).values[key]
+
 class ExpressionSet(object):
     """ExpressionSet class mimics R's Bioconductor ExpressionSet.
 
@@ -24,11 +72,13 @@ class ExpressionSet(object):
 
     Create an ExpressionSet instance:
 
-      eSet = ExpressionSet(exprs, fData=None, pData=None, **kwargs)
+      eSet = ExpressionSet(exprs, fData=None, pData=None, validate=True, **kwargs)
 
       exprs: expression dataframe (genes x samples)
       fData: feature dataframe (genes x features)
       pData: phenotype dataframe (samples x phenotypes)
+      validate: check that fData/pData are aligned with exprs (skip it only if they
+                are aligned by construction, e.g., sliced together with exprs)
       kwargs: metadata (e.g., title) (saved in eSet.meta)
 
     Test if a given sample/gene exists in the eSet:
@@ -38,16 +88,44 @@ class ExpressionSet(object):
     >>> 'GTEX.ZXG5.0011.R7b.SM.57WCC' in eSet
     True
 
+    Subset without copying the expression values:
+
+    >>> liver = eSet.subset(samples=liver_samples, view=True)
+
+    Iterate over blocks of features (axis=0) or samples (axis=1):
+
+    >>> for block in eSet.iter_blocks(axis=1, size=1000):
+    ...     pass
+
+    Compute a feature-by-feature correlation matrix in a streaming pass over samples:
+
+    >>> cor = eSet.corr(method='pearson')
+    >>> cor = eSet.corr(method='spearman', out='cor.h5')  # written tile by tile to disk
+
+    Keep several assays of the same features x samples (exprs is the assay 'exprs'):
+
+    >>> eSet.set_assay('counts', counts)  # a dataframe aligned with exprs, or a 2-D array
+    >>> eSet.derive_assay('logTPM', lambda df: np.log2(df + 1), source='TPM')  # computed on first access
+    >>> eSet.assays
+    ['exprs', 'counts', 'TPM', 'logTPM']
+    >>> logtpm = eSet.assay('logTPM')
+
     Get/set the metadata:
 
     >>> eSet.meta['title'] = "Title of the eSet"
     >>> print eSet.meta['title']
     Title of the eSet
     """
-    def __init__(self, exprs, fData=None, pData=None, **kwargs):
+    def __init__(self, exprs, fData=None, pData=None, validate=True, **kwargs):
+        self._assays = OrderedDict()  # other assays: 2-D arrays aligned with exprs, or _Derived
+        self._derived = {}  # cached values of derived assays
         self.exprs = exprs  # property
-        self.fData = fData  # property
-        self.pData = pData  # property
+        if validate:
+            self.fData = fData  # property
+            self.pData = pData  # property
+        else:
+            self._fData = fData if fData is not None else pd.DataFrame()
+            self._pData = pData if pData is not None else pd.DataFrame()
         self.meta = pd.Series(kwargs)  # metadata
 
     def __str__(self):
@@ -58,11 +136,11 @@ class ExpressionSet(object):
               'features: {}, ..., {}\n'
               'samples: {}, ..., {}\n').format(
               self.meta.get('title', 'ExpressionSet instance'),
-              self._exprs.shape[0], self._exprs.shape[1],
+              len(self.features), len(self.samples),
               self._fData.shape[0], self._fData.shape[1],
               self._pData.shape[0], self._pData.shape[1],
-              self._exprs.index[0], self._exprs.index[-1],
-              self._exprs.columns[0], self._exprs.columns[-1])
+              self.features[0], self.features[-1],
+              self.samples[0], self.samples[-1])
         s2 = '\n'.join(["{}: {}".format(k, v) for k,v in self.meta.iteritems() if k != 'title'])
         return s1 + s2
 
@@ -70,20 +148,183 @@ class ExpressionSet(object):
         return self.__str__()
 
     def __contains__(self, item):
-        return item in self._exprs or item in self._exprs.index
+        return item in self.samples or item in self.features
 
-    def subset(self, features=slice(None), samples=slice(None)):
+    def subset(self, features=slice(None), samples=slice(None), view=False):
         """Subset by given features/samples.
 
         features: a sequence of feature names (default: all features)
         samples: a sequence of sample names (default: all samples)
+        view: if True, copy no expression values: the subset keeps the positions of
+              its features/samples in this eSet, and reads them on access, read-only
+              (as views when the positions are evenly spaced, e.g., a range of samples).
+
+        Derived assays are computed on this eSet (once, then cached) and subset, so
+        they are the same as subsetting the full assay, whatever func does.
 
-        Return a new ExpressionSet.
+        Return a new ExpressionSet (with all assays), or a LazyExpressionSet if view is True.
         """
+        if view:
+            from .LazyExpressionSet import _subset_view, _FrameArray
+            # .values is a view only if exprs has a single dtype
+            values = self._exprs.values if self._exprs.dtypes.nunique() <= 1 else _FrameArray(self._exprs)
+            return _subset_view(self, values, features, samples)
         exprs = self._exprs.loc[features, samples]
-        fData = self._fData.loc[features] if not self._fData.empty else pd.DataFrame()
-        pData = self._pData.loc[samples]  if not self._pData.empty else pd.DataFrame()
-        return ExpressionSet(exprs, fData, pData, **self.meta)
+        fData = self._fData.loc[features] if not self._fData.empty else None
+        pData = self._pData.loc[samples]  if not self._pData.empty else None
+        eSet = ExpressionSet(exprs, fData, pData, validate=False, **self.meta)
+        for name in self._assays:
+            eSet._assays[name] = self.assay(name).loc[features, samples].values
+        return eSet
+
+    @property
+    def assays(self):
+        """Assay names ('exprs' first)"""
+        return ['exprs'] + list(self._assays)
+
+    def assay(self, name='exprs'):
+        """Get an assay as a dataframe (genes x samples).
+
+        All assays share the feature/sample index of exprs. A derived assay is
+        computed on first access and cached.
+        """
+        if name == 'exprs':
+            return self.exprs
+        values = self._assays[name]
+        if isinstance(values, _Derived):
+            if name not in self._derived:
+                df = values.func(self.assay(values.source))
+                self._derived[name] = self._aligned(df)
+            values = self._derived[name]
+        elif not isinstance(values, np.ndarray):
+            values = values[:, :]  # an on-disk array
+        return pd.DataFrame(values, index=self.features, columns=self.samples, copy=False)
+
+    def set_assay(self, name, data):
+        """Add (or replace) an assay.
+
+        name: assay name ('exprs' replaces exprs)
+        data: a dataframe with the features and samples of exprs (in order), or a 2-D array
+        """
+        self._derived.clear()  # derived assays may depend on this one
+        if name == 'exprs':
+            self.exprs = data if isinstance(data, pd.DataFrame) else \
+                pd.DataFrame(data, index=self.features, columns=self.samples)
+        else:
+            self._assays[name] = self._aligned(data)
+
+    def derive_assay(self, name, func, source='exprs'):
+        """Add an assay computed on access from another assay, e.g., log2(TPM + 1).
+
+        name: assay name
+        func: a function of the source assay (a dataframe), returning a dataframe or a 2-D array
+        source: name of the source assay
+        """
+        assert name != 'exprs' and (source == 'exprs' or source in self._assays)
+        self._derived.pop(name, None)
+        self._assays[name] = _Derived(func, source)
+
+    def _aligned(self, data):
+        """Return the 2-D array of an assay, checking that it aligns with exprs."""
+        if isinstance(data, pd.DataFrame):
+            assert _same_index(data.index, self.features) and _same_index(data.columns, self.samples)
+            data = data.values
+        assert data.shape == (len(self.features), len(self.samples))
+        return data
+
+    def iter_blocks(self, axis=0, size=1024):
+        """Iterate over blocks of the expression dataframe.
+
+        axis: 0 for blocks of features (rows), 1 for blocks of samples (columns).
+        size: number of features/samples per block.
+
+        Yield expression dataframes (views when possible).
+        """
+        n = self._exprs.shape[axis]
+        for i in xrange(0, n, size):
+            yield self._exprs.iloc[i:i+size] if axis == 0 else self._exprs.iloc[:, i:i+size]
+
+    def _rows(self, i, j):
+        """Expression values of the features at positions i to j (a 2-D array), reading nothing else."""
+        return self._exprs.iloc[i:j].values
+
+    def corr(self, method='pearson', size=1024, out=None, tile=4096):
+        """Feature-by-feature covariance/correlation matrix.
+
+        method: 'cov', 'pearson', or 'spearman'.
+        size: number of samples (or features, when ranking) per streamed block.
+        out: an HDF5 path (optional). If given, the result is written tile by tile as a
+             chunked matrix, so a matrix larger than memory can be produced.
+        tile: number of features per output tile (if out is given).
+
+        Without out, the sums and cross products of (shifted) features are accumulated
+        over blocks of samples in one streaming pass. With out, a streaming pass
+        computes the means and standard deviations first, then each tile is the
+        product of two blocks of centered features.
+
+        Note: 'spearman' first ranks every feature across samples (streaming blocks
+        of features) and keeps the ranks in memory.
+
+        Return a features x features dataframe, or a LazyExpressionSet backed by out.
+        """
+        n = len(self.samples)
+        if method == 'spearman':
+            ranks = np.concatenate([block.rank(axis=1).values for block in self.iter_blocks(axis=0, size=size)])
+            rows = lambda i, j: ranks[i:j]
+            blocks = lambda: (ranks[:, k:k+size] for k in xrange(0, n, size))
+        elif method in ('cov', 'pearson'):
+            rows = lambda i, j: self._rows(i, j).astype(float)
+            blocks = lambda: (block.values.astype(float) for block in self.iter_blocks(axis=1, size=size))
+        else:
+            raise ValueError("Unsupported method. Must be cov, pearson, or spearman.")
+        # streaming pass over samples; features are shifted by their means in the
+        # first block to avoid catastrophic cancellation
+        shift, s, ss, S = None, 0, 0, 0
+        for X in blocks():
+            if shift is None:
+                shift = X.mean(axis=1)
+            X = X - shift[:, None]
+            s = s + X.sum(axis=1)
+            if out is None:
+                S = S + X.dot(X.T)
+            else:
+                ss = ss + np.square(X).sum(axis=1)
+        if out is None:
+            C = (S - np.outer(s, s) / n) / (n - 1)
+            if method != 'cov':
+                sd = np.sqrt(np.diag(C))
+                C /= sd[:, None]
+                C /= sd[None, :]
+            return pd.DataFrame(C, index=self.features, columns=self.features)
+        # blocked output mode
+        from .LazyExpressionSet import LazyExpressionSet, create_chunked_exprs, _default_chunkshape
+        mean = shift + s / n
+        sd = np.sqrt((ss - np.square(s) / n) / (n - 1))
+        m = len(self.features)
+        array = create_chunked_exprs(out, self.features, self.features, chunkshape=_default_chunkshape(m, m))
+        for i in xrange(0, m, tile):
+            Xi = rows(i, i + tile) - mean[i:i+tile, None]
+            for j in xrange(i, m, tile):
+                Xj = Xi if j == i else rows(j, j + tile) - mean[j:j+tile, None]
+                C = Xi.dot(Xj.T) / (n - 1)
+                if method != 'cov':
+                    C /= sd[i:i+tile, None]
+                    C /= sd[None, j:j+tile]
+                array[i:i+tile, j:j+tile] = C
+                if j != i:
+                    array[j:j+tile, i:i+tile] = C.T
+        array.flush()
+        return LazyExpressionSet(array, self.features, self.features, title=method, source=out)
+
+    @property
+    def features(self):
+        """Feature names (index of exprs)"""
+        return self._exprs.index
+
+    @property
+    def samples(self):
+        """Sample names (columns of exprs)"""
+        return self._exprs.columns
 
     @property
     def exprs(self):
@@ -93,6 +334,9 @@ class ExpressionSet(object):
     @exprs.setter
     def exprs(self, df):
         assert isinstance(df, pd.DataFrame)
+        if self._assays:  # other assays are aligned with exprs
+            assert _same_index(df.index, self.features) and _same_index(df.columns, self.samples)
+        self._derived.clear()  # derived assays may depend on exprs
         self._exprs = df
 
     @property
@@ -102,7 +346,7 @@ class ExpressionSet(object):
 
     @fData.setter
     def fData(self, df):
-        assert df is None or all(df.index == self._exprs.index)  # check if features are aligned
+        assert df is None or _same_index(df.index, self.features)  # check if features are aligned
         self._fData = df if df is not None else pd.DataFrame()  # if df is None, use an empty DataFrame
 
     @property
@@ -112,5 +356,31 @@ class ExpressionSet(object):
 
     @pData.setter
     def pData(self, df):
-        assert df is None or all(df.index == self._exprs.columns)  # check if samples are aligned
+        assert df is None or _same_index(df.index, self.samples)  # check if samples are aligned
         self._pData = df if df is not None else pd.DataFrame()  # if df is None, use an empty DataFrame
+
+if __name__ == "__main__":
+    # Micro-benchmark of the alignment checks: python -m omics.expression.ExpressionSet
+    import time
+    def bench(f, repeat=5):
+        t = time.time()
+        for _ in xrange(repeat):
+            f()
+        return (time.time() - t) / repeat * 1000
+    def cold(exprs, fData):
+        for index in (exprs.index, fData.index):
+            index.__dict__.pop('_omics_aligned', None)
+        return ExpressionSet(exprs, fData)
+    print "ms per construction with fData (cold/warm: labels compared/alignment cached)"
+    print "%9s %12s %8s %8s %11s %15s" % ('features', 'elementwise', 'cold', 'warm', 'same index', 'validate=False')
+    for n in [1000, 10000, 56000, 1000000]:
+        labels = ['ENSG%011d' % i for i in xrange(n)]
+        exprs = pd.DataFrame(np.zeros((n, 2)), index=pd.Index(labels))
+        fData = pd.DataFrame({'symbol': labels}, index=pd.Index(labels))  # equal labels, another Index
+        shared = pd.DataFrame({'symbol': labels}, index=exprs.index)
+        print "%9d %12.3f %8.3f %8.3f %11.3f %15.3f" % (n,
+            bench(lambda: all(fData.index == exprs.index)),  # the former check
+            bench(lambda: cold(exprs, fData)),
+            bench(lambda: ExpressionSet(exprs, fData)),
+            bench(lambda: ExpressionSet(exprs, shared)),
+            bench(lambda: ExpressionSet(exprs, fData, validate=False)))
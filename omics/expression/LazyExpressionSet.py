@@ -0,0 +1,374 @@
+"""Definition of LazyExpressionSet class.
+
+LazyExpressionSet is an ExpressionSet whose expression matrix stays on disk,
+e.g., as a chunked and compressed PyTables CArray written by
+omics.io.ExpressionSetIO.ExpressionSet2HDF5(eSet, HDF5, format='chunked').
+
+Only the feature/sample names, fData, pData, and metadata are held in memory
+(other assays may stay on disk as well),
+so printing, membership tests, and alignment checks never touch the matrix.
+Expression values are read on demand, chunk by chunk.
+"""
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from .ExpressionSet import ExpressionSet, _Derived, _DerivedArray
+
+__author__ = "Cho-Yi Chen"
+__version__ = "2016.10.16"
+
+def _runs(ids):
+    """Split sorted unique integers into runs of consecutive integers.
+
+    Return a list of (start, stop) tuples.
+    """
+    breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+    return [(run[0], run[-1] + 1) for run in np.split(ids, breaks) if len(run)]
+
+def _split_runs(runs, n):
+    """Split (start, stop) runs into runs of at most n integers."""
+    return [(i, min(i + n, stop)) for start, stop in runs for i in xrange(start, stop, n)]
+
+def _default_chunkshape(nrow, ncol):
+    """Chunks of up to 256 x 256 (at least 1 x 1, as HDF5 requires)."""
+    return max(1, min(256, nrow)), max(1, min(256, ncol))
+
+def _read_chunks(array, rows, cols, max_chunks=64):
+    """Read array[rows, :][:, cols] by touching only the chunks needed.
+
+    array: a 2-D array-like, e.g., a PyTables CArray (with chunkshape) or a numpy array.
+    rows, cols: integer positions.
+    max_chunks: the most chunks read at once, which bounds the memory used
+      besides the output (e.g., 64 chunks of 256 x 256 doubles take 32 MB).
+
+    Return a numpy array.
+    """
+    rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+    chunkshape = getattr(array, 'chunkshape', None)
+    if chunkshape is None:
+        # in-memory array: fancy indexing is already cheap
+        return array[np.ix_(rows, cols)]
+    nrow, ncol = array.shape
+    cr, cc = chunkshape
+    urows, rinv = np.unique(rows, return_inverse=True)
+    ucols, cinv = np.unique(cols, return_inverse=True)
+    out = np.empty((len(urows), len(ucols)), dtype=array.dtype)
+    # read runs of consecutive row chunks x runs of consecutive column chunks,
+    # split into tiles of at most max_chunks chunks
+    col_runs = _split_runs(_runs(np.unique(ucols // cc)), max_chunks)
+    width = max(c1 - c0 for c0, c1 in col_runs) if col_runs else 1
+    for r0, r1 in _split_runs(_runs(np.unique(urows // cr)), max(1, max_chunks // width)):
+        r0, r1 = r0 * cr, min(r1 * cr, nrow)
+        ri = slice(np.searchsorted(urows, r0), np.searchsorted(urows, r1))
+        for c0, c1 in col_runs:
+            c0, c1 = c0 * cc, min(c1 * cc, ncol)
+            ci = slice(np.searchsorted(ucols, c0), np.searchsorted(ucols, c1))
+            block = array[r0:r1, c0:c1]
+            out[ri, ci] = block[np.ix_(urows[ri] - r0, ucols[ci] - c0)]
+    if len(urows) != len(rows) or (urows != rows).any():
+        out = out[rinv]
+    if len(ucols) != len(cols) or (ucols != cols).any():
+        out = out[:, cinv]
+    return out
+
+def _positions(index, labels):
+    """Integer positions of labels (a sequence or slice(None)) in index."""
+    if isinstance(labels, slice):
+        return np.arange(len(index))[index.slice_indexer(labels.start, labels.stop, labels.step)]
+    pos = index.get_indexer(labels)
+    if (pos < 0).any():
+        raise KeyError('Not found: {}'.format(list(np.asarray(labels)[pos < 0])[:5]))
+    return pos
+
+def _as_slice(pos):
+    """A slice equivalent to evenly spaced ascending positions, or the positions themselves."""
+    if len(pos) == 0:
+        return slice(0, 0)
+    step = pos[1] - pos[0] if len(pos) > 1 else 1
+    if step > 0 and (np.diff(pos) == step).all():
+        return slice(pos[0], pos[-1] + 1, step)
+    return pos
+
+def _take(array, rows, cols):
+    """array[rows, :][:, cols] (integer positions) as a read-only array.
+
+    Evenly spaced positions of a numpy array give a view of it; other positions,
+    or other array-likes, give a copy.
+    """
+    rows, cols = _as_slice(rows), _as_slice(cols)
+    if isinstance(array, _FrameArray):
+        out = array[rows, cols]
+    elif isinstance(rows, slice) and isinstance(cols, slice):
+        out = array[rows, cols].view()
+    elif isinstance(rows, slice):
+        out = array[rows][:, cols]
+    elif isinstance(cols, slice):
+        out = array[:, cols][rows]
+    else:
+        out = array[np.ix_(rows, cols)]
+    out.flags.writeable = False
+    return out
+
+class _FrameArray(object):
+    """A dataframe as a 2-D array-like, reading only the rows and columns asked.
+
+    For a dataframe of several dtypes, whose .values would copy it entirely.
+    """
+    def __init__(self, df):
+        self.df = df
+
+    @property
+    def shape(self):
+        return self.df.shape
+
+    @property
+    def dtype(self):
+        return self.df.iloc[:0].values.dtype
+
+    def __getitem__(self, key):
+        rows, cols = key
+        return self.df.iloc[rows, cols].values
+
+class _ArrayView(object):
+    """Rows and columns (integer positions) of a 2-D array-like, read on access.
+
+    Every read is read-only (copy it to modify). Evenly spaced positions of a numpy
+    array are read as a view of it; other positions are gathered into a new array,
+    which is kept once the whole view has been read, so later reads index into it.
+    Views of views compose their positions, so they refer to the original array
+    (or to the gathered array of the parent view, if it was kept).
+
+    Examples:
+
+    >>> X = np.arange(20.).reshape(4, 5)
+    >>> v = _ArrayView(X, [3, 0, 2], [1, 3, 4])
+    >>> vv = _ArrayView(v, [2, 0], [0, 2])  # positions in v
+    >>> np.array_equal(vv[:, :], pd.DataFrame(X).loc[[2, 3], [1, 4]].values)
+    True
+    >>> sliced = _ArrayView(X, [1, 2], [0, 2, 4])  # evenly spaced: a view of X
+    >>> np.shares_memory(sliced[:, :], X)
+    True
+    >>> sliced[:, :][0, 0] = -1  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ValueError: assignment destination is read-only
+    >>> v[:, :][0, 0] = -1  # gathered copies are read-only too  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ValueError: assignment destination is read-only
+    >>> v.gathered is not None  # kept after the whole view was read
+    True
+    >>> np.array_equal(v[[2, 0], [0, 2]], vv[:, :])  # later reads index into it
+    True
+    >>> np.array_equal(_ArrayView(v, [2, 0], [0, 2])[:, :], vv[:, :])  # and so do views of it
+    True
+    """
+    def __init__(self, array, rows, cols):
+        if isinstance(array, _ArrayView):
+            if array.gathered is not None:
+                array = array.gathered
+            else:
+                array, rows, cols = array.array, array.rows[rows], array.cols[cols]
+        self.array = array
+        self.rows = np.asarray(rows, dtype=int)
+        self.cols = np.asarray(cols, dtype=int)
+        self.gathered = None  # the whole view, once read, if it is not a numpy view
+        self._gathers = (isinstance(array, _FrameArray) or getattr(array, 'chunkshape', None) is not None
+                         or not isinstance(_as_slice(self.rows), slice) or not isinstance(_as_slice(self.cols), slice))
+
+    @property
+    def shape(self):
+        return len(self.rows), len(self.cols)
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def __getitem__(self, key):
+        if self.gathered is not None:
+            return _take(self.gathered, np.arange(len(self.rows))[key[0]].ravel(),
+                         np.arange(len(self.cols))[key[1]].ravel())
+        rows, cols = self.rows[key[0]].ravel(), self.cols[key[1]].ravel()
+        if getattr(self.array, 'chunkshape', None) is not None:
+            out = _read_chunks(self.array, rows, cols)
+            out.flags.writeable = False
+        else:
+            out = _take(self.array, rows, cols)
+        if self._gathers and all(isinstance(k, slice) and k == slice(None) for k in key):
+            self.gathered = out
+        return out
+
+def _subset_view(eSet, array, features, samples):
+    """Subset an ExpressionSet as a LazyExpressionSet of views (see ExpressionSet.subset).
+
+    eSet: an ExpressionSet (or LazyExpressionSet)
+    array: its exprs as a 2-D array-like
+    """
+    def select(index, df, labels):
+        # an axis not subset keeps its index and dataframe (shared with eSet)
+        if isinstance(labels, slice) and labels == slice(None):
+            return np.arange(len(index)), index, df
+        pos = _positions(index, labels)
+        return pos, index[pos], df.iloc[pos] if not df.empty else df
+    rows, features, fData = select(eSet.features, eSet._fData, features)
+    cols, samples, pData = select(eSet.samples, eSet._pData, samples)
+    # aligned by construction, so the alignment checks are skipped
+    view = LazyExpressionSet(_ArrayView(array, rows, cols), features, samples, fData, pData, validate=False, **eSet.meta)
+    for name, values in eSet._assays.iteritems():
+        if isinstance(values, _Derived):
+            values = _DerivedArray(eSet, name)  # computed on eSet when read
+        view._assays[name] = _ArrayView(values, rows, cols)
+    return view
+
+def create_chunked_exprs(HDF5, features, samples, dtype='float64', chunkshape=None, complevel=5, complib='blosc', name='exprs'):
+    """Create an empty, chunked and compressed (features x samples) matrix in HDF5.
+
+    The feature/sample names are saved as Pandas series '<name>_features' and
+    '<name>_samples', the layout read by omics.io.ExpressionSetIO.HDF52ExpressionSet.
+
+    Return the PyTables CArray, open for writing (close it by array._v_file.close()).
+    """
+    import tables
+    if len(features) == 0 or len(samples) == 0:
+        raise ValueError('A chunked matrix cannot be empty: {} x {}'.format(len(features), len(samples)))
+    store = pd.HDFStore(HDF5)
+    store[name + '_features'] = pd.Series(features)
+    store[name + '_samples'] = pd.Series(samples)
+    store.close()
+    nrow, ncol = len(features), len(samples)
+    chunkshape = chunkshape or _default_chunkshape(nrow, ncol)
+    h5 = tables.open_file(HDF5, 'a')
+    if '/' + name in h5:
+        h5.remove_node('/' + name)
+    return h5.create_carray(h5.root, name, atom=tables.Atom.from_dtype(np.dtype(dtype)),
+                            shape=(nrow, ncol), chunkshape=chunkshape,
+                            filters=tables.Filters(complevel=complevel, complib=complib))
+
+class LazyExpressionSet(ExpressionSet):
+    """ExpressionSet backed by an on-disk (chunked) expression matrix.
+
+    Usage
+    -----
+
+    Usually created by omics.io.ExpressionSetIO.HDF52ExpressionSet on a chunked HDF5:
+
+      eSet = HDF52ExpressionSet(HDF5)  # returns a LazyExpressionSet
+
+    or directly from any 2-D array-like (features x samples):
+
+      eSet = LazyExpressionSet(array, features, samples, fData=None, pData=None, validate=True, **kwargs)
+
+    Read a subset into memory (only the chunks needed are read):
+
+      sub = eSet.subset(features=genes, samples=samples)  # an in-memory ExpressionSet
+
+    or keep it on disk (nothing is read until used):
+
+      sub = eSet.subset(features=genes, samples=samples, view=True)  # a LazyExpressionSet
+
+    Stream blocks of features/samples to downstream stats:
+
+      for block in eSet.iter_blocks(axis=0):
+          pass
+
+    Replace the matrix with an in-memory one (same features and samples, in order):
+
+      eSet.exprs = eSet.exprs.clip(lower=0)  # or eSet.set_assay('exprs', df)
+
+    Close the underlying file:
+
+      eSet.close()
+    """
+    def __init__(self, array, features, samples, fData=None, pData=None, validate=True, **kwargs):
+        assert array.shape == (len(features), len(samples))
+        self._array = array
+        self._assays = OrderedDict()  # other assays: 2-D array-likes (e.g., on-disk arrays), or _Derived
+        self._derived = {}  # cached values of derived assays
+        self._features = features if isinstance(features, pd.Index) else pd.Index(features)
+        self._samples = samples if isinstance(samples, pd.Index) else pd.Index(samples)
+        if validate:
+            self.fData = fData  # property
+            self.pData = pData  # property
+        else:
+            self._fData = fData if fData is not None else pd.DataFrame()
+            self._pData = pData if pData is not None else pd.DataFrame()
+        self.meta = pd.Series(kwargs)  # metadata
+
+    def subset(self, features=slice(None), samples=slice(None), view=False):
+        """Subset by given features/samples, reading only the chunks needed.
+
+        features: a sequence of feature names (default: all features)
+        samples: a sequence of sample names (default: all samples)
+        view: if True, read nothing; return a LazyExpressionSet over the same matrix.
+
+        Return a new (in-memory) ExpressionSet, or a LazyExpressionSet if view is True.
+        """
+        if view:
+            return _subset_view(self, self._array, features, samples)
+        rows = _positions(self._features, features)
+        cols = _positions(self._samples, samples)
+        exprs = pd.DataFrame(_read_chunks(self._array, rows, cols),
+                             index=self._features[rows], columns=self._samples[cols])
+        fData = self._fData.iloc[rows] if not self._fData.empty else None
+        pData = self._pData.iloc[cols] if not self._pData.empty else None
+        eSet = ExpressionSet(exprs, fData, pData, validate=False, **self.meta)
+        for name, values in self._assays.iteritems():
+            if isinstance(values, _Derived):
+                values = _DerivedArray(self, name)  # computed on this eSet, then subset
+            eSet._assays[name] = _read_chunks(values, rows, cols)
+        return eSet
+
+    def iter_blocks(self, axis=0, size=None):
+        """Iterate over blocks of the on-disk expression matrix.
+
+        axis: 0 for blocks of features (rows), 1 for blocks of samples (columns).
+        size: number of features/samples per block (default: the chunk size along axis).
+
+        Yield expression dataframes.
+        """
+        chunkshape = getattr(self._array, 'chunkshape', None) or (1024, 1024)
+        size = size or chunkshape[axis]
+        n = self._array.shape[axis]
+        for i in xrange(0, n, size):
+            if axis == 0:
+                yield pd.DataFrame(self._array[i:i+size, :], index=self._features[i:i+size], columns=self._samples)
+            else:
+                yield pd.DataFrame(self._array[:, i:i+size], index=self._features, columns=self._samples[i:i+size])
+
+    def _rows(self, i, j):
+        """Expression values of the features at positions i to j (a 2-D array), reading nothing else."""
+        return self._array[i:j, :]
+
+    def close(self):
+        """Close the underlying file (if any)."""
+        h5 = getattr(self._array, '_v_file', None) or getattr(self, '_h5', None)
+        if h5 is not None:
+            h5.close()
+
+    @property
+    def exprs(self):
+        """Expression dataframe (genes x samples), read entirely into memory"""
+        return pd.DataFrame(self._array[:, :], index=self._features, columns=self._samples)
+
+    @exprs.setter
+    def exprs(self, df):
+        """Replace the matrix with an in-memory one (the features and samples stay the same)."""
+        assert isinstance(df, pd.DataFrame)
+        h5 = getattr(self._array, '_v_file', None)
+        if h5 is not None:
+            self._h5 = h5  # still closed by close(): other assays may be read from it
+        self._array = self._aligned(df)
+        self._derived.clear()  # derived assays may depend on exprs
+
+    @property
+    def features(self):
+        """Feature names"""
+        return self._features
+
+    @property
+    def samples(self):
+        """Sample names"""
+        return self._samples
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -2,9 +2,13 @@
 """
 # The core class
 from .ExpressionSet import ExpressionSet
+from .LazyExpressionSet import LazyExpressionSet
 
 # I/O tools
 from ..io.ExpressionSetIO import RData2ExpressionSet
+from ..io.ExpressionSetIO import RDS2ExpressionSet
 from ..io.ExpressionSetIO import HDF52ExpressionSet
+from ..io.ExpressionSetIO import Binary2ExpressionSet
 from ..io.ExpressionSetIO import ExpressionSet2RData
 from ..io.ExpressionSetIO import ExpressionSet2HDF5
+from ..io.ExpressionSetIO import ExpressionSet2Binary
@@ -7,6 +7,7 @@ Ding C, Peng H
 J Bioinform Comput Biol. 2005 Apr; 3(2) 185-205
 DOI: 10.1142/S0219720005001004, PMID: 15852500
 """
+import numpy as np
 import pandas as pd
 from itertools import product
 
@@ -33,7 +34,7 @@ def _MIQ_score(df, S, y):
     """
     return _relevance(df, S, y) / _redundancy(df, S)
 
-def MRMR(df, y, n=10, criterion='MID', to_exclude=[]):
+def MRMR(df, y, n=10, criterion='MID', to_exclude=[], verbose=True):
     """Heuristic algorithm described on page 188 (p.4).
 
     df: MI matrix derived from omics.stats.MI
@@ -41,38 +42,76 @@ def MRMR(df, y, n=10, criterion='MID', to_exclude=[]):
     n: how many features to select
     criterion: scoring criterion, either 'MID' or 'MIQ'
     to_exclude: do not search for these feature names
+    verbose: print each selected feature or not
+
+    The scores are those of equations (4) and (5) on the selected set S + [f],
+    updated incrementally: the relevance sum of S, the redundancy double sum of S,
+    and a running vector of redundancy sums between S and every candidate are kept,
+    so each selection step costs O(k) for k features.
 
     Return a dataframe of selected features and their MRMR scores (MID or MIQ) indexed by their selection order (starts from 0).
+
+    The incremental scores equal equations (4) and (5) computed from scratch:
+
+    >>> X = np.random.RandomState(0).rand(8, 8)
+    >>> mi = pd.DataFrame(X + X.T, index=list('abcdefgh'), columns=list('abcdefgh'))
+    >>> S = MRMR(mi, 'a', n=4, verbose=False)
+    >>> np.allclose(S.Score[1:], [_MID_score(mi, S.Name[:k], 'a') for k in (2, 3, 4)])
+    True
+    >>> S = MRMR(mi, 'a', n=4, criterion='MIQ', verbose=False)
+    >>> np.allclose(S.Score[1:], [_MIQ_score(mi, S.Name[:k], 'a') for k in (2, 3, 4)])
+    True
     """
-    # Setup
-    F = set(df.index) - set([y]) - set(to_exclude)  # initial feature-to-select set
-    S = []  # selected feature list
-    n = n if n < len(F) else len(F)  # to select n features
-    scores = []  # selected feature scores
-    maxlen = sorted([len(i) for i in df.index])[-1]  # max feature name length
-    
-    # Select first feature
-    f = df[y][F].idxmax()  # 1st feature: largest MI(f, y)
-    S.append(f)
-    scores.append(df[y][f])
-    F.remove(f)
-    print "Selected feature  1 / %d: %*s (MRMR Score = %.2g)" % (n, maxlen, f, df[y][f])
-    
     # Select criterion
     if criterion == "MID":
-        get_score = lambda f: _MID_score(df, S + [f], y)
+        get_score = lambda V, W: V - W
     elif criterion == "MIQ":
-        get_score = lambda f: _MIQ_score(df, S + [f], y)
+        get_score = lambda V, W: V / W
     else:
-        raise Exception("Unsupported criterion. Must be either MID or MIQ.")    
-    
-    # Select next feature
-    for i in range(1, n):
-        f = sorted(F, key=get_score, reverse=True)[0]  # feature w/ largest MRMR score
-        s = get_score(f)
-        S.append(f)
+        raise Exception("Unsupported criterion. Must be either MID or MIQ.")
+
+    # Setup
+    mat = df.values  # mat[j, i] == df[i][j]
+    names = df.index
+    iy = names.get_loc(y)
+    F = ~names.isin([y] + list(to_exclude))  # candidate mask
+    S = []  # selected feature list
+    n = n if n < F.sum() else F.sum()  # to select n features
+    scores = []  # selected feature scores
+    maxlen = sorted([len(i) for i in df.index])[-1]  # max feature name length
+    relevance = mat[:, iy]  # df[y][f] for every feature f
+    diagonal = np.diag(mat)
+    sum_V = 0.  # sum of relevance over S
+    sum_W = 0.  # sum of redundancy over S x S
+    cross_W = np.zeros(len(names))  # sum of df[s][f] + df[f][s] over s in S, for every feature f
+
+    for i in range(n):
+        if i == 0:
+            # 1st feature: largest MI(f, y)
+            candidates = np.where(F, relevance, -np.inf)
+            f = candidates.argmax()
+            s = relevance[f]
+        else:
+            # feature w/ largest MRMR score of S + [f]
+            k = len(S) + 1.
+            V = (sum_V + relevance) / k
+            W = (sum_W + cross_W + diagonal) / k ** 2
+            with np.errstate(divide='ignore', invalid='ignore'):
+                candidates = np.where(F, get_score(V, W), -np.inf)
+            f = candidates.argmax()
+            s = candidates[f]
+        # update running sums
+        sum_V += relevance[f]
+        sum_W += cross_W[f] + diagonal[f]
+        cross_W += mat[f, :] + mat[:, f]
+        S.append(names[f])
         scores.append(s)
-        F.remove(f)
-        print "Selected feature %2d / %2d: %*s (MRMR Score = %.2g)" % (i+1, n, maxlen, f, s)
+        F[f] = False
+        if verbose:
+            print "Selected feature %2d / %2d: %*s (MRMR Score = %.2g)" % (i+1, n, maxlen, names[f], s)
 
     return pd.DataFrame({'Name': S, 'Score': scores})
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -3,15 +3,25 @@
 import os.path
 import pandas as pd
 
+from .GeneSetIndex import GeneSetIndex
+
 __author__ = "Cho-Yi Chen"
 __version__ = "2016.10.16"
 
 class GeneSetCollection(object):
     """A collection of gene sets.
 
-    * Load GMT file via GeneSetCollection(GMT).
+    * Load GMT file via GeneSetCollection(GMT, cache_dir=None).
+      The gene sets are compiled into a sparse GeneSetIndex (see omics.gsa.GeneSetIndex),
+      which is cached in cache_dir (if given) and memory-mapped in later loads.
+    * Or create one via GeneSetCollection.from_genesets(dict) or .from_index(GeneSetIndex),
+      e.g., omics.gsa.MSigDB.xml2collection(XML).
     * Search(gene): Input a gene, list all gene sets containing the input gene (symbol).
     * Enrichment(genes): Input a gene list, get enrichment results against all gene sets in the collection.
+    * Enrichment_batch(queries): Input many gene lists, get all enrichment results in one tidy dataframe.
+    * GSEA(rnk): Input a ranked gene list (Series), get preranked GSEA results of all gene sets.
+    * Score_samples(eSet): Get per-sample scores (ssGSEA or z-score) of all gene sets as an ExpressionSet.
+    * Overlap(): Get pairwise overlaps, Jaccard indices, and Fisher's p-values between all gene sets.
 
     >>> GMT = "/ifs/labs/cccb/projects/share/MSigDB/gmt/c2.cp.kegg.v5.1.symbols.gmt"
     >>> gmt = GeneSetCollection(GMT)
@@ -23,48 +33,74 @@ class GeneSetCollection(object):
     True
 
     >>> gmt.search('CCNB3')
-    ['KEGG_P53_SIGNALING_PATHWAY', 'KEGG_PROGESTERONE_MEDIATED_OOCYTE_MATURATION', 'KEGG_CELL_CYCLE']
+    ['KEGG_CELL_CYCLE', 'KEGG_P53_SIGNALING_PATHWAY', 'KEGG_PROGESTERONE_MEDIATED_OOCYTE_MATURATION']
 
     >>> df = gmt.enrichment(['PER1', 'PER2', 'PER3', 'CLOCK', 'CRY1', 'CRY2', 'ARNTL', 'TP53'])
     >>> df[df.FDR < 0.05].index
     Index([u'KEGG_CIRCADIAN_RHYTHM_MAMMAL'], dtype='object', name=u'Name')
+
+    >>> df = gmt.enrichment_batch({'clock': ['PER1', 'PER2', 'PER3', 'CLOCK', 'CRY1', 'CRY2', 'ARNTL', 'TP53']})
+    >>> df[df.FDR < 0.05].index.tolist()
+    [('clock', 'KEGG_CIRCADIAN_RHYTHM_MAMMAL')]
+
+    >>> df = gmt.gsea(rnk, permute=1000, n_jobs=4)  # rnk: a Series of gene to statistic
+
+    >>> scores = gmt.score_samples(eSet, method='ssgsea')  # gene sets x samples
+
+    >>> df = gmt.overlap(min_jaccard=0.5)  # redundant pairs of gene sets
     """
-    def __init__(self, input_file_path):
+    def __init__(self, input_file_path, cache_dir=None):
         self.source = input_file_path
         if input_file_path.endswith(".gmt"):
-            self.genesets = self._load_gmt(input_file_path)
+            self.index = GeneSetIndex.from_gmt(input_file_path, cache_dir=cache_dir)
         else:
             raise e, 'Unsupported file format.'
+        self._genesets = None
+        self.background = None
+
+    @classmethod
+    def from_index(cls, index, source='gene sets'):
+        """Create a collection from a compiled GeneSetIndex (e.g., built from MSigDB XML)."""
+        self = cls.__new__(cls)
+        self.source = source
+        self.index = index
+        self._genesets = None
+        self.background = None
+        return self
+
+    @classmethod
+    def from_genesets(cls, genesets, source='gene sets'):
+        """Create a collection from a dict of gene set name to genes."""
+        return cls.from_index(GeneSetIndex.from_genesets(genesets), source)
 
     def __str__(self):
-        return '{}: {} gene sets'.format(os.path.basename(self.source), len(self.genesets))
+        return '{}: {} gene sets'.format(os.path.basename(self.source), len(self.index.names))
 
     def __repr__(self):
         return self.__str__()
 
     def __contains__(self, geneset):
-        return geneset in self.genesets
+        return self.index.set_indices([geneset])[0] >= 0
 
-    def _load_gmt(self, path):
-        D = {}  # a gene_set_name-to-gene_set dict
-        for line in open(path):
-            L = line.strip().split('\t')
-            name = L[0]
-            genelist = L[2:]
-            D[name] = set(genelist)
-        return D
+    @property
+    def genesets(self):
+        """A gene_set_name-to-gene_set dict (built from the index on first access)"""
+        if self._genesets is None:
+            self._genesets = self.index.to_genesets()
+        return self._genesets
 
     def search(self, gene):
-        return [key for key, geneset in self.genesets.iteritems() if gene in geneset]
+        return self.index.search(gene)
 
     def enrichment(self, genes, background=None, min_size=10, max_size=500):
         from scipy.stats import fisher_exact
-        from statsmodels.stats.multitest import multipletests
+        from ..stats.FDR import p_adjust
         # Make sure the input gene list is a set
         if not isinstance(genes, set):
             genes = set(genes)
         # Get consensus background
-        self.background = set.union(*self.genesets.values())
+        if self.background is None:
+            self.background = set(self.index.genes.tolist())
         if background is None:
             background = self.background
         else:
@@ -82,7 +118,147 @@ class GeneSetCollection(object):
                 odds, pval = fisher_exact([[a, b-a], [c-a, d-b-c+a]])
                 out.append([name, a, b, c, odds, pval])
         df = pd.DataFrame(out, columns=['Name', 'Hits', 'Input', 'Size', 'OddsRatio', 'PValue']).set_index('Name')
-        df['FDR'] = multipletests(df['PValue'], method='fdr_bh')[1]
+        df['FDR'] = p_adjust(df['PValue'].values, 'BH')
+        return df
+
+    def enrichment_batch(self, queries, background=None, min_size=10, max_size=500):
+        """Enrichment analysis of many query gene lists in one call.
+
+        queries: a dict (or Series) of query name to gene list, or a list of gene lists.
+        background: background genes shared by all queries (default: all genes in the collection).
+        min_size, max_size: only test gene sets within this size range.
+
+        All 2x2 tables are built from one sparse product of a query-by-gene and the
+        compiled gene-by-set incidence matrix, and the p-values are computed at once by the
+        vectorized one-sided Fisher's exact test (see omics.stats.fisher).
+
+        Return a tidy dataframe indexed by (Query, Name) with per-query BH FDR.
+        """
+        import numpy as np
+        from scipy.sparse import csr_matrix
+        from ..stats.fisher import fisher_exact_test
+        from ..stats.FDR import p_adjust
+        # Query names and gene lists
+        if hasattr(queries, 'keys'):
+            qnames = list(queries.keys())
+            qlists = [queries[k] for k in qnames]
+        else:
+            qlists = list(queries)
+            qnames = range(len(qlists))
+        index = self.index
+        # Restrict the incidence matrix to background genes and gene sets within size range
+        if background is None:
+            bg = np.arange(len(index.genes))
+        else:
+            bg = np.unique(index.gene_indices(set(background)))
+            bg = bg[bg >= 0]
+        sizes = index.sizes
+        keep = np.flatnonzero((min_size <= sizes) & (sizes <= max_size))
+        M = index.matrix[bg][:, keep]
+        names = index.names[keep]
+        local = np.zeros(len(index.genes), dtype=int) - 1  # gene id to background coordinate
+        local[bg] = np.arange(len(bg))
+        # Query-by-gene incidence matrix (in background coordinates)
+        rows, cols = [], []
+        for i, genelist in enumerate(qlists):
+            idx = index.gene_indices(set(genelist))
+            idx = local[idx[idx >= 0]]
+            idx = idx[idx >= 0]
+            rows.extend([i] * len(idx))
+            cols.extend(idx)
+        Q = csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(qlists), len(bg)))
+        # Marginal numbers of all 2x2 tables (see omics.stats.fisher)
+        a = (Q * M).toarray()           # hits: queries x gene sets
+        b = np.asarray(Q.sum(axis=1))   # input sizes: queries x 1
+        c = np.asarray(M.sum(axis=0))   # gene set sizes: 1 x gene sets
+        d = len(bg)                     # background size
+        odds, pval = fisher_exact_test(a, b, c, d, alternative='greater', verbose=False)
+        fdr = p_adjust(pval.T, 'BH').T  # per query
+        # Tidy output
+        nq, ns = a.shape
+        df = pd.DataFrame({'Query': np.repeat(qnames, ns),
+                           'Name': np.tile(names, nq),
+                           'Hits': a.ravel().astype(int),
+                           'Input': np.repeat(b.ravel(), ns).astype(int),
+                           'Size': np.tile(c.ravel(), nq).astype(int),
+                           'OddsRatio': odds.ravel(),
+                           'PValue': pval.ravel(),
+                           'FDR': fdr.ravel()},
+                          columns=['Query', 'Name', 'Hits', 'Input', 'Size', 'OddsRatio', 'PValue', 'FDR'])
+        return df.set_index(['Query', 'Name'])
+
+    def gsea(self, rnk, **kwargs):
+        """Preranked GSEA of a ranked gene list against all gene sets.
+
+        rnk: a Series of gene to statistic
+        kwargs: passed to omics.gsa.GSEA.gsea, e.g., min_size, max_size, permute, seed, n_jobs
+
+        Return a dataframe indexed by gene set name with columns Size, ES, NES, PValue, FDR_BH.
+        """
+        from .GSEA import gsea
+        return gsea(rnk, self.index, **kwargs)
+
+    def score_samples(self, eSet, **kwargs):
+        """Single-sample scores (ssGSEA or z-score) of all gene sets in every sample of an ExpressionSet.
+
+        kwargs: passed to omics.gsa.ssGSEA.score_samples, e.g., method, alpha, min_size, max_size
+
+        Return an ExpressionSet of gene sets x samples.
+        """
+        from .ssGSEA import score_samples
+        return score_samples(eSet, self.index, **kwargs)
+
+    def overlap(self, background=None, min_overlap=1, min_jaccard=0., alternative='greater', tile=1024):
+        """Pairwise overlaps between all gene sets in the collection.
+
+        background: background genes for Fisher's exact test (default: all genes in the collection).
+        min_overlap: only report pairs sharing at least this many genes (must be >= 1).
+        min_jaccard: only report pairs with at least this Jaccard index.
+        alternative: alternative hypothesis of Fisher's exact test (see omics.stats.fisher).
+          Only pairs that share genes are tested: pairs with no overlap, the most
+          depleted ones, are never reported, so 'less' and 'two-sided' only rank
+          depletion among overlapping pairs.
+        tile: number of gene sets per tile.
+
+        The overlap counts of a tile of gene sets against all gene sets are one sparse
+        product of the set-by-gene and gene-by-set incidence matrices. Only pairs
+        (Set1 < Set2) above the thresholds are kept, so the memory is bounded by one tile
+        and the reported pairs.
+
+        Return a tidy dataframe with columns Set1, Set2, Overlap, Size1, Size2, Jaccard, PValue.
+        """
+        import numpy as np
+        from ..stats.fisher import fisher_exact_test
+        assert min_overlap >= 1
+        index = self.index
+        if background is None:
+            bg = np.arange(len(index.genes))
+        else:
+            bg = np.unique(index.gene_indices(set(background)))
+            bg = bg[bg >= 0]
+        M = index.matrix[bg].tocsc()  # background genes x gene sets
+        MT = M.T.tocsr()              # gene sets x background genes
+        sizes = np.asarray(M.sum(axis=0)).ravel()
+        out = []
+        for i in xrange(0, M.shape[1], tile):
+            O = (MT[i:i+tile] * M[:, i:]).tocoo()  # tile x (gene sets from i on)
+            row, col = O.row + i, O.col + i
+            keep = (row < col) & (O.data >= min_overlap)
+            row, col, o = row[keep], col[keep], O.data[keep]
+            jaccard = 1. * o / (sizes[row] + sizes[col] - o)
+            keep = np.flatnonzero(jaccard >= min_jaccard)
+            keep = keep[np.lexsort((col[keep], row[keep]))]
+            out.append((row[keep], col[keep], o[keep], jaccard[keep]))
+        row, col, o, jaccard = [np.concatenate(v) for v in zip(*out)] if out else [np.array([], dtype=int)] * 4
+        pval = fisher_exact_test(o, sizes[row], sizes[col], len(bg), alternative=alternative, verbose=False)[1]
+        df = pd.DataFrame({'Set1': index.names[row],
+                           'Set2': index.names[col],
+                           'Overlap': o,
+                           'Size1': sizes[row],
+                           'Size2': sizes[col],
+                           'Jaccard': jaccard,
+                           'PValue': pval},
+                          columns=['Set1', 'Set2', 'Overlap', 'Size1', 'Size2', 'Jaccard', 'PValue'])
         return df
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+"""GeneSetIndex class: a compiled sparse index of a gene set collection.
+
+A GeneSetIndex holds:
+  * genes: sorted gene vocabulary (gene <-> integer row)
+  * names: sorted gene set names (gene set <-> integer column)
+  * indptr, indices: a CSR gene x set incidence matrix, whose rows are the
+    inverted gene -> gene sets posting lists
+
+The arrays can be saved to a binary cache directory keyed by the md5 of the
+source file. Loading from the cache memory-maps the arrays instead of parsing text.
+
+>>> index = GeneSetIndex.from_gmt(GMT, cache_dir='~/.cache/omics')
+>>> index.search('CCNB3')
+['KEGG_CELL_CYCLE', 'KEGG_P53_SIGNALING_PATHWAY', 'KEGG_PROGESTERONE_MEDIATED_OOCYTE_MATURATION']
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+
+__author__ = "Cho-Yi Chen"
+__version__ = "2016.10.16"
+
+def _md5(path, blocksize=1 << 20):
+    """Return the md5 hex digest of a file."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def _rename_dir(tmp, path):
+    """Rename the directory tmp to path, unless path exists.
+
+    An existing path (e.g., saved by another process meanwhile, which may be
+    reading it) is kept as it is, and tmp is left for the caller to remove.
+    """
+    if os.path.isdir(path):
+        return
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+class GeneSetIndex(object):
+    """Compiled sparse index of gene sets.
+
+    Build an index from a dict of gene sets or a GMT file:
+
+      index = GeneSetIndex.from_genesets(genesets)
+      index = GeneSetIndex.from_gmt(GMT, cache_dir=None)
+
+    Save/load the index to/from a directory of .npy files:
+
+      index.save(path)
+      index = GeneSetIndex.load(path, mmap_mode='r')
+    """
+    _arrays = ('genes', 'names', 'indptr', 'indices')
+
+    def __init__(self, genes, names, indptr, indices):
+        self.genes = genes      # sorted gene vocabulary
+        self.names = names      # sorted gene set names
+        self.indptr = indptr    # CSR row pointers (genes + 1)
+        self.indices = indices  # CSR column indices (gene set ids)
+        self._matrix = None
+
+    def __str__(self):
+        return 'GeneSetIndex: {} genes, {} gene sets, {} memberships'.format(
+            len(self.genes), len(self.names), len(self.indices))
+
+    def __repr__(self):
+        return self.__str__()
+
+    @classmethod
+    def from_genesets(cls, genesets):
+        """Compile a dict of gene set name to genes."""
+        names = np.array(sorted(genesets))
+        genes = np.array(sorted(set().union(*genesets.values())))
+        # set-major (CSC) arrays first, then transpose them to gene-major (CSR)
+        cols = np.repeat(np.arange(len(names)), [len(genesets[k]) for k in names])
+        rows = np.searchsorted(genes, [g for k in names for g in genesets[k]])
+        order = np.lexsort((cols, rows))
+        indices = cols[order].astype(np.int32)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(genes)))])
+        return cls(genes, names, indptr, indices)
+
+    @classmethod
+    def from_gmt(cls, path, cache_dir=None):
+        """Compile a GMT file.
+
+        path: the GMT file path.
+        cache_dir: if given, load the index from (or save it to) a cache
+          directory keyed by the md5 of the GMT file.
+        """
+        if cache_dir is None:
+            return cls.from_genesets(_read_gmt(path))
+        cache_dir = os.path.expanduser(cache_dir)
+        cache = os.path.join(cache_dir, '{}.{}'.format(os.path.basename(path), _md5(path)))
+        if os.path.isdir(cache):
+            return cls.load(cache)
+        index = cls.from_genesets(_read_gmt(path))
+        index.save(cache)
+        return index
+
+    def save(self, path):
+        """Save the index arrays as .npy files under the directory path.
+
+        The files are written into a temporary directory next to path, which is
+        then renamed to path, so an interrupted or concurrent save never leaves
+        a partial index behind. An existing path is kept (caches are keyed by the
+        md5 of their source, so it holds the same index); remove it to overwrite.
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = tempfile.mkdtemp(prefix='.' + os.path.basename(path) + '.', dir=parent)
+        try:
+            for k in self._arrays:
+                np.save(os.path.join(tmp, k + '.npy'), getattr(self, k))
+            _rename_dir(tmp, path)
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load (memory-map by default) the index arrays from the directory path."""
+        return cls(*[np.load(os.path.join(path, k + '.npy'), mmap_mode=mmap_mode) for k in cls._arrays])
+
+    @property
+    def matrix(self):
+        """Sparse gene x set incidence matrix (CSR)."""
+        if self._matrix is None:
+            from scipy.sparse import csr_matrix
+            data = np.ones(len(self.indices), dtype=np.int32)
+            self._matrix = csr_matrix((data, self.indices, self.indptr), shape=(len(self.genes), len(self.names)))
+        return self._matrix
+
+    @property
+    def sizes(self):
+        """Gene set sizes."""
+        return np.bincount(self.indices, minlength=len(self.names))
+
+    def _lookup(self, sorted_keys, keys):
+        keys = np.asarray(list(keys))
+        out = np.zeros(len(keys), dtype=int) - 1
+        if len(keys) and len(sorted_keys):
+            i = np.searchsorted(sorted_keys, keys).clip(0, len(sorted_keys) - 1)
+            out = np.where(sorted_keys[i] == keys, i, -1)
+        return out
+
+    def gene_indices(self, genes):
+        """Integer ids of the given genes (-1 if not indexed)."""
+        return self._lookup(self.genes, genes)
+
+    def set_indices(self, names):
+        """Integer ids of the given gene set names (-1 if not indexed)."""
+        return self._lookup(self.names, names)
+
+    def search(self, gene):
+        """List all gene set names containing the gene."""
+        i = self.gene_indices([gene])[0]
+        if i < 0:
+            return []
+        return self.names[self.indices[self.indptr[i]:self.indptr[i+1]]].tolist()
+
+    def members(self, name):
+        """List all genes in the gene set."""
+        j = self.set_indices([name])[0]
+        if j < 0:
+            raise KeyError(name)
+        return self.genes[self.matrix[:, j].nonzero()[0]].tolist()
+
+    def to_genesets(self):
+        """Return a dict of gene set name to a set of genes."""
+        M = self.matrix.tocsc()
+        genes = self.genes.tolist()
+        return dict((name, set(genes[i] for i in M.indices[M.indptr[j]:M.indptr[j+1]]))
+                    for j, name in enumerate(self.names.tolist()))
+
+def _read_gmt(path):
+    """Parse a GMT file into a gene_set_name-to-gene_set dict."""
+    D = {}
+    for line in open(path):
+        L = line.strip().split('\t')
+        D[L[0]] = set(L[2:])
+    return D
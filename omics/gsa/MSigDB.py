@@ -1,15 +1,110 @@
 """Load MSigDB gene set metadata.
+
+The (gzipped) MSigDB XML is parsed incrementally: each GENESET element is read,
+its attributes are kept, and the element is cleared right away, so memory stays
+flat regardless of the size of the release.
+
+* xml2df(path): gene set metadata as a dataframe indexed by STANDARD_NAME.
+* xml2collection(path): member genes as a GeneSetCollection.
+
+If cache_dir is given, the results are cached under a directory keyed by the md5
+of the XML file (metadata as a pickle, members as a GeneSetIndex), so later loads
+skip the XML entirely.
 """
 import pandas as pd
 import gzip
-import xml.etree.ElementTree as ET
+import os
+import tempfile
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+from .GeneSetIndex import GeneSetIndex, _md5
+from .GeneSetCollection import GeneSetCollection
 
 XML = '../MSigDB/xml/msigdb_v5.1.xml.gz'
 attributes = ['STANDARD_NAME', 'CATEGORY_CODE', 'SUB_CATEGORY_CODE', 'DESCRIPTION_BRIEF'] # 'EXTERNAL_DETAILS_URL'
 
-def xml2df(path, attributes=attributes):
-    tree = ET.parse(gzip.open(path))
-    root = tree.getroot()
-    data = [[gs.attrib[k] for k in attributes] for gs in root.iter('GENESET')]
+def _iter_genesets(path):
+    """Iterate over the attribute dicts of GENESET elements, clearing each one after use."""
+    f = gzip.open(path) if path.endswith('.gz') else open(path, 'rb')
+    try:
+        context = iter(ET.iterparse(f, events=('start', 'end')))
+        event, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag == 'GENESET':
+                yield dict(elem.attrib)
+                elem.clear()
+                root.clear()  # drop references to the parsed elements
+    finally:
+        f.close()
+
+def _cache_path(path, cache_dir):
+    return os.path.join(os.path.expanduser(cache_dir), '{}.{}'.format(os.path.basename(path), _md5(path)))
+
+def _save_pickle(df, path):
+    """Pickle df to a temporary file next to path, then rename it to path."""
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):  # not created by another process meanwhile
+                raise
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=parent)
+    os.close(fd)
+    try:
+        df.to_pickle(tmp)
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def xml2df(path, attributes=attributes, cache_dir=None):
+    """Load gene set metadata from MSigDB XML.
+
+    path: the MSigDB XML (or XML.gz) file path
+    attributes: GENESET attributes to extract (STANDARD_NAME is the index)
+    cache_dir: if given, load (or save) all non-member attributes from (to) a
+      pickle in cache_dir, keyed by the md5 of the XML file
+
+    Missing attributes are filled with '', with or without the cache.
+
+    Return a dataframe indexed by STANDARD_NAME.
+    """
+    columns = [k for k in attributes if k != 'STANDARD_NAME']
+    if cache_dir is not None:
+        cache = os.path.join(_cache_path(path, cache_dir), 'metadata.pkl')
+        if os.path.exists(cache):
+            return pd.read_pickle(cache).reindex(columns=columns, fill_value='')
+        data = [dict((k, v) for k, v in gs.items() if not k.startswith('MEMBERS'))
+                for gs in _iter_genesets(path)]
+        df = pd.DataFrame(data).set_index('STANDARD_NAME').fillna('')
+        _save_pickle(df, cache)
+        return df.reindex(columns=columns, fill_value='')
+    data = [[gs.get(k, '') for k in attributes] for gs in _iter_genesets(path)]
     df = pd.DataFrame(data, columns=attributes).set_index('STANDARD_NAME')
     return df
+
+def xml2collection(path, members='MEMBERS_SYMBOLIZED', cache_dir=None):
+    """Load the member genes of all gene sets from MSigDB XML.
+
+    path: the MSigDB XML (or XML.gz) file path
+    members: the GENESET attribute of comma-separated member genes,
+      e.g., 'MEMBERS_SYMBOLIZED' (gene symbols) or 'MEMBERS_EZID' (Entrez IDs)
+    cache_dir: if given, load (or save) the compiled GeneSetIndex from (to) cache_dir,
+      keyed by the md5 of the XML file
+
+    Return a GeneSetCollection.
+    """
+    if cache_dir is not None:
+        cache = os.path.join(_cache_path(path, cache_dir), members)
+        if os.path.isdir(cache):
+            return GeneSetCollection.from_index(GeneSetIndex.load(cache), path)
+    genesets = dict((gs['STANDARD_NAME'], set(filter(None, gs.get(members, '').split(','))))
+                    for gs in _iter_genesets(path))
+    index = GeneSetIndex.from_genesets(genesets)
+    if cache_dir is not None:
+        index.save(cache)
+    return GeneSetCollection.from_index(index, path)
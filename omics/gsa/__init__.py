@@ -1,6 +1,9 @@
 """Gene Set Analysis Module
 """
-from GeneSetCollection import GeneSetCollect
+from GeneSetCollection import GeneSetCollection
+from GeneSetIndex import GeneSetIndex
+from GSEA import gsea
+from ssGSEA import score_samples
 
 def enrichment(gene_list, gene_set, background, alternative="two-sided", verbose=True):
     """Gene set enrichment analysis by Fisher Exact Test.
@@ -1,16 +1,30 @@
 """I/O functions that operate on omics ExpressionSet objects.
 
 Supported:
-  * I/O from/to Bioconductor ExpressionSet (RData)
-  * I/O from/to HDF5 storage (Pandas dataframes)
+  * I/O from/to Bioconductor ExpressionSet (RData), via rpy2
+  * Input from Bioconductor ExpressionSet (RDS or RData) without R (see omics.io.RDataReader)
+  * I/O from/to HDF5 storage (Pandas dataframes, or a chunked and compressed exprs matrix)
+  * I/O from/to a binary directory (a memory-mapped exprs matrix, with Parquet fData/pData)
 
 Input:
-  * RData2ExpressionSet(RData, assay='exprs', fFactors='auto', pFactors='auto')
-  * HDF52ExpressionSet(HDF5, assay='exprs', fData='fData', pData='pData')
+  * RData2ExpressionSet(RData, assay='exprs', fFactors='auto', pFactors='auto', engine='rpy2')
+  * RDS2ExpressionSet(RDS, assay='exprs', fFactors='auto', pFactors='auto')
+  * HDF52ExpressionSet(HDF5, assay='exprs', fData='fData', pData='pData', features=None, samples=None, fQuery=None, pQuery=None)
+  * Binary2ExpressionSet(path, mmap_mode='r')
 
 Output:
   * ExpressionSet2RData(eSet, RData)
-  * ExpressionSet2HDF5(eSet, HDF5)
+  * ExpressionSet2HDF5(eSet, HDF5, format='fixed')
+  * ExpressionSet2Binary(eSet, path, dtype=None)
+
+Binary directory layout:
+  * exprs.npy: the (features x samples) matrix as a NumPy .npy file (C order)
+  * index.pkl: feature and sample names (pandas Index objects, dtypes preserved)
+    and the names of the other assays
+  * fData.parquet, pData.parquet: feature and phenotype dataframes (categoricals
+    preserved), or fData.pkl, pData.pkl if pyarrow is not installed or cannot
+    store them (e.g., non-string column names)
+  * meta.pkl: metadata
 
 References:
   * http://pandas.pydata.org/pandas-docs/stable/r_interface.html
@@ -19,14 +33,11 @@ References:
 Todo:
   * Add tests.
 """
-import readline
-
 import pandas as pd
-from rpy2.robjects import r
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.packages import importr
+import os
 
 from ..expression.ExpressionSet import ExpressionSet
+from ..expression.LazyExpressionSet import LazyExpressionSet, create_chunked_exprs, _positions, _default_chunkshape
 
 __author__ = "Cho-Yi Chen"
 __version__ = "2016.10.16"
@@ -35,6 +46,17 @@ __version__ = "2016.10.16"
 # Auxiliary functions
 # ================================================================================
 
+def _rpy2():
+    """Import rpy2 on demand (it starts an embedded R), with readline imported first.
+
+    Return r, pandas2ri, importr.
+    """
+    import readline
+    from rpy2.robjects import r
+    from rpy2.robjects import pandas2ri
+    from rpy2.robjects.packages import importr
+    return r, pandas2ri, importr
+
 def _read_ExpressionSet_RData(RData):
     """Read ExpressionSet RData to Rpy2 robjects.
 
@@ -43,6 +65,7 @@ def _read_ExpressionSet_RData(RData):
 
     Return Rpy2's eSet object, assayData, featureData, phenotypeData.
     """
+    r, pandas2ri, importr = _rpy2()
     importr('Biobase')
     rdata = r.load(RData)
     eSet = r.get(rdata)           # rpy2 ExpressionSet object (assumed)
@@ -51,20 +74,45 @@ def _read_ExpressionSet_RData(RData):
     pData = r.pData(eSet)         # rpy2 DataFrame object
     return eSet, assayData, fData, pData
 
+def _r_matrix_to_numpy(mat, size=1024):
+    """Wrap an R numeric matrix (rpy2 object) as a 2-D numpy array.
+
+    Double matrices are wrapped without copying: the array is a column-major view
+    of R's buffer (and keeps the R object alive). Integer/logical matrices are
+    converted into a float array, a block of columns at a time, with R's NA
+    (the smallest 32-bit integer) as NaN.
+
+    size: number of columns converted per block.
+    """
+    import numpy as np
+    r = _rpy2()[0]
+    data = np.asarray(mat)
+    if data.ndim == 1:
+        data = data.reshape(tuple(r.dim(mat)), order='F')  # a view of R's column-major buffer
+    if data.dtype == np.float64:
+        return data
+    out = np.empty(data.shape, dtype=np.float64, order='F')
+    for i in xrange(0, data.shape[1], size):
+        block = data[:, i:i+size]
+        out[:, i:i+size] = block
+        out[:, i:i+size][block == np.iinfo(np.int32).min] = np.nan
+    return out
+
 def _parse_assayData(assayData, assay):
     """Parse Rpy2 assayData (Environment object)
 
     assayData: Rpy2 Environment object.
     assay: An assay name indicating the data to be loaded.
 
-    Return a parsed expression dataframe (Pandas).
+    Return a parsed expression dataframe (Pandas), whose values share memory with
+    the R matrix when it is a double matrix (see _r_matrix_to_numpy).
     """
-    pandas2ri.activate()
+    r = _rpy2()[0]
     mat = assayData[assay]  # rpy2 expression matrix object
-    data = pandas2ri.ri2py(mat)
-    features = pandas2ri.ri2py(r.rownames(mat))
-    samples = pandas2ri.ri2py(r.colnames(mat))
-    return pd.DataFrame(data, index=features, columns=samples)
+    data = _r_matrix_to_numpy(mat)
+    features = list(r.rownames(mat))
+    samples = list(r.colnames(mat))
+    return pd.DataFrame(data, index=features, columns=samples, copy=False)
 
 def _parse_rdataframe(rdf, factor_cols='auto'):
     """Parse an Rpy2 DataFrame.
@@ -76,13 +124,17 @@ def _parse_rdataframe(rdf, factor_cols='auto'):
 
     Return a pandas dataframe.
     """
+    r, pandas2ri, importr = _rpy2()
     pandas2ri.activate()
-    df = pandas2ri.ri2py(rdf)
+    return _infer_factors(pandas2ri.ri2py(rdf), factor_cols)
+
+def _infer_factors(df, factor_cols='auto'):
+    """Make factor columns of a dataframe categorical (see _parse_rdataframe)."""
     if factor_cols == 'auto':
-        # Infer if there are categorical data
+        # Infer if there are categorical data (less than 1 distinct value per 10 rows)
         n = df.shape[0]
-        subdf = df.select_dtypes(include=['integer', 'object'])
-        factor_cols = [k for k,v in subdf.iteritems() if n > 10 * len(set(v))]
+        nunique = df.select_dtypes(include=['integer', 'object']).nunique(dropna=False)
+        factor_cols = nunique.index[n > 10 * nunique].tolist()
     if factor_cols:
         # Make each column categorical
         assert not isinstance(factor_cols, str)
@@ -90,11 +142,81 @@ def _parse_rdataframe(rdf, factor_cols='auto'):
             df[k] = df[k].astype('category')
     return df
 
+def _assay_key(name, exprs='exprs'):
+    """Key (HDF5) or file name (binary directory) of an assay: exprs for 'exprs', else 'assay_<name>'."""
+    return exprs if name == 'exprs' else 'assay_' + name
+
+def _iter_assay_blocks(eSet, assay, size):
+    """Iterate over blocks of features of an assay (see ExpressionSet.iter_blocks)."""
+    if assay == 'exprs':
+        return eSet.iter_blocks(axis=0, size=size)
+    df = eSet.assay(assay)
+    return (df.iloc[i:i+size] for i in xrange(0, len(df), size))
+
+def _write_chunked_exprs(eSet, HDF5, name, chunkshape, complevel, complib, assay='exprs'):
+    """Write exprs (or another assay) into HDF5 as a chunked and compressed PyTables CArray.
+
+    The matrix is written block by block (see ExpressionSet.iter_blocks).
+    """
+    chunkshape = chunkshape or _default_chunkshape(len(eSet.features), len(eSet.samples))
+    blocks = _iter_assay_blocks(eSet, assay, chunkshape[0])
+    block = next(blocks, None)  # None if there are no features
+    dtype = block.values.dtype if block is not None else 'float64'
+    array = create_chunked_exprs(HDF5, eSet.features, eSet.samples, dtype,
+                                 chunkshape=chunkshape, complevel=complevel, complib=complib, name=name)
+    i = 0
+    while block is not None:
+        array[i:i+len(block), :] = block.values
+        i += len(block)
+        block = next(blocks, None)
+    array._v_file.close()
+
+def _select_labels(names, df, labels=None, query=None):
+    """Resolve a selection of features/samples.
+
+    names: all feature/sample names (a pandas Index)
+    df: fData/pData (an empty dataframe if there is none)
+    labels: a sequence of names, or None for all
+    query: a query on df (see DataFrame.query), or None
+
+    Return the selected names (in the order of labels, or of names), or slice(None) for all.
+    """
+    if labels is None and query is None:
+        return slice(None)
+    selected = names if labels is None else pd.Index(labels)
+    if query is not None:
+        if df.empty:
+            raise ValueError('No fData/pData to query: {}'.format(query))
+        selected = selected[selected.isin(df.query(query).index)]
+    return selected
+
+def _write_frame(df, path, name):
+    """Write a dataframe as name.parquet (via pyarrow) or, if that fails, name.pkl.
+
+    Parquet fails if pyarrow is unavailable or the dataframe has what parquet cannot
+    store, e.g., non-string column names or columns of mixed types.
+    """
+    parquet = os.path.join(path, name + '.parquet')
+    try:
+        df.to_parquet(parquet, engine='pyarrow')
+    except Exception:
+        if os.path.exists(parquet):
+            os.remove(parquet)
+        df.to_pickle(os.path.join(path, name + '.pkl'))
+
+def _read_frame(path, name):
+    """Read a dataframe written by _write_frame, or return None if there is none."""
+    if os.path.exists(os.path.join(path, name + '.parquet')):
+        return pd.read_parquet(os.path.join(path, name + '.parquet'), engine='pyarrow')
+    if os.path.exists(os.path.join(path, name + '.pkl')):
+        return pd.read_pickle(os.path.join(path, name + '.pkl'))
+    return None
+
 # ================================================================================
 # Input functions
 # ================================================================================
 
-def RData2ExpressionSet(RData, assay='exprs', fFactors='auto', pFactors='auto', verbose=True, **kwargs):
+def RData2ExpressionSet(RData, assay='exprs', fFactors='auto', pFactors='auto', verbose=True, engine='rpy2', **kwargs):
     """Read R's ExpressionSet (RData) to omics ExpressionSet (eSet)
 
     RData: Path to the input RData file with only one eSet object inside.
@@ -102,10 +224,18 @@ def RData2ExpressionSet(RData, assay='exprs', fFactors='auto', pFactors='auto',
     f/pFactors: List of column names indicating categorical data (factors in R).
       If 'auto', factor columns will be determined by their contents, individually.
       If None, do nothing and use the default dtypes.
+    verbose: 0 (or False) for silence, 1 (or True) to report the file, 2 to also print the R object.
+    engine: 'rpy2' to load the RData in an embedded R, or
+            'python' to parse it without R (see RDS2ExpressionSet).
     kwargs: Keyword arguments passed to ExpressionSet constructor
 
+    The other matrices in assayData are loaded as other assays (see ExpressionSet.assay).
+    A double expression matrix is not copied: exprs is a view of the R matrix.
+
     Return a omics ExpressionSet object (eSet).
     """
+    if engine == 'python':
+        return RDS2ExpressionSet(RData, assay, fFactors, pFactors, verbose, **kwargs)
     # Read RData into Rpy2 robjects
     r_eSet, r_assayData, r_fData, r_pData = _read_ExpressionSet_RData(RData)
     # Parse assayData, fData, and pData
@@ -116,50 +246,223 @@ def RData2ExpressionSet(RData, assay='exprs', fFactors='auto', pFactors='auto',
     kwargs['source'] = RData
     if verbose:
         print "Loading eSet from", RData
+    if verbose > 1:
         print r_eSet
-    return ExpressionSet(exprs, fData, pData, **kwargs)
+    eSet = ExpressionSet(exprs, fData, pData, **kwargs)
+    for name in _rpy2()[0].ls(r_assayData):
+        if name != assay:
+            eSet.set_assay(name, _parse_assayData(r_assayData, name))
+    return eSet
+
+def RDS2ExpressionSet(RDS, assay='exprs', fFactors='auto', pFactors='auto', verbose=True, **kwargs):
+    """Read R's ExpressionSet (RDS or RData) to omics ExpressionSet (eSet), without R.
+
+    RDS: Path to the input RDS file (saveRDS), or RData file (save) with only one eSet object inside.
+    assay: Assay name to be loaded.
+    f/pFactors: List of column names indicating categorical data (R factors are always categorical).
+      If 'auto', other factor columns will be determined by their contents, individually.
+      If None, do nothing and use the default dtypes.
+    verbose: 0 (or False) for silence, 1 (or True) to report the file, 2 to also print the R object.
+    kwargs: Keyword arguments passed to ExpressionSet constructor
+
+    The file is parsed by omics.io.RDataReader, which reads the expression matrix
+    straight into a NumPy buffer; exprs is a view of that buffer.
+    The other matrices in assayData are loaded as other assays (see ExpressionSet.assay).
+
+    Return a omics ExpressionSet object (eSet).
 
-def HDF52ExpressionSet(HDF5, exprs='exprs', fData='fData', pData='pData', meta='meta', verbose=True):
+    Examples (a tiny ExpressionSet in omics/io/demo, as an RDS and an RData file):
+
+    >>> import os
+    >>> demo = os.path.join(os.path.dirname(__file__), 'demo')
+    >>> rds = RDS2ExpressionSet(os.path.join(demo, 'eset.rds'), verbose=False)
+    >>> rda = RDS2ExpressionSet(os.path.join(demo, 'eset.RData'), verbose=False)
+    >>> rds.exprs.equals(rda.exprs) and rds.pData.equals(rda.pData) and rds.fData.equals(rda.fData)
+    True
+    >>> print ', '.join(rds.features), '|', ', '.join(rds.samples)
+    TP53, EGFR, MYC | S1, S2, S3, S4
+    >>> rds.exprs.values.tolist()  # an integer matrix with an NA
+    [[5.0, 0.0, 12.0, 7.0], [3.0, nan, 8.0, 1.0], [0.0, 2.0, 4.0, 9.0]]
+    >>> print ', '.join(map(str, rds.pData['tissue']))  # a factor with an NA
+    Liver, Lung, Liver, nan
+    >>> rds.pData['batch'].tolist()  # an ALTREP compact sequence (1:4)
+    [1, 2, 3, 4]
+    """
+    from .RDataReader import is_rdata, read_rds, read_rdata, as_pandas
+    if is_rdata(RDS):
+        objs = read_rdata(RDS)
+        obj = [v for v in objs.values() if v is not None and v.inherits('ExpressionSet')]
+        if len(obj) != 1:
+            raise ValueError('Expecting exactly one ExpressionSet in {}'.format(RDS))
+        obj = obj[0]
+    else:
+        obj = read_rds(RDS)
+    if obj is None or not obj.inherits('ExpressionSet'):
+        raise ValueError('Not an ExpressionSet: {}'.format(RDS))
+    # Parse assayData (an environment, or a list), fData, and pData
+    assayData = obj.attr('assayData')
+    if assayData.type == 'environment':
+        assays = assayData.value
+    else:
+        assays = dict(zip(assayData.attr('names').value, assayData.value))
+    exprs = as_pandas(assays[assay])
+    fData = as_pandas(obj.attr('featureData').attr('data'))
+    pData = as_pandas(obj.attr('phenoData').attr('data'))
+    fData = _infer_factors(fData, fFactors) if fData.shape[1] > 0 else None
+    pData = _infer_factors(pData, pFactors) if pData.shape[1] > 0 else None
+    # Add metadata
+    kwargs['source'] = RDS
+    if verbose:
+        print "Loading eSet from", RDS
+    if verbose > 1:
+        print obj
+        print 'assayData:', ', '.join(sorted(assays))
+    eSet = ExpressionSet(exprs, fData, pData, **kwargs)
+    for name in sorted(assays):
+        if name != assay:
+            eSet.set_assay(name, as_pandas(assays[name]))
+    return eSet
+
+def HDF52ExpressionSet(HDF5, exprs='exprs', fData='fData', pData='pData', meta='meta', verbose=True,
+                       features=None, samples=None, fQuery=None, pQuery=None):
     """Read HDF file into ExpressionSet.
 
     HDF5: the input HDF5 path.
     exprs: the name of the exprsstion table .
     fData: the name of the feature table, or None.
     pData: the name of the phenotype table, or None.
-
-    Return an ExpressionSet object.
+    meta: the name of the metadata series, or None.
+    features, samples: only load these features/samples (in this order), or None for all.
+    fQuery, pQuery: only load features/samples whose fData/pData satisfy this
+                    query (see DataFrame.query), e.g., pQuery="SMTSD == 'Liver'".
+
+    The selection is resolved against fData/pData first. Then only the selected rows
+    (features) of a table-format exprs, or the chunks needed of a chunked exprs, are read.
+    A table-format exprs stores all samples of a row together, so selecting samples
+    does not reduce what is read from it: each selected row is read in full and the
+    other samples are dropped. Use the chunked format to read a subset of samples.
+    A fixed-format exprs is read entirely and subset in memory.
+    Other assays saved by ExpressionSet2HDF5 are read in the same way.
+
+    Return an ExpressionSet object, or a LazyExpressionSet object if exprs
+    was saved in the chunked format and nothing is selected (the HDF5 file stays
+    open until eSet.close()).
     """
+    import numpy as np
+    import tables
     store = pd.HDFStore(HDF5)
-    hdf_exprs = store[exprs]
-    hdf_fData = store[fData] if isinstance(fData, str) else None
-    hdf_pData = store[pData] if isinstance(pData, str) else None
-    hdf_meta = store[meta]   if isinstance(meta, str)  else {}
+    chunked = isinstance(store.get_node(exprs), tables.CArray)
+    table = not chunked and store.get_storer(exprs).is_table
+    hdf_fData = store[fData] if isinstance(fData, str) and fData in store else pd.DataFrame()
+    hdf_pData = store[pData] if isinstance(pData, str) and pData in store else pd.DataFrame()
+    hdf_meta = store[meta]   if isinstance(meta, str) and meta in store else {}
     hdf_meta['source'] = HDF5
+    names = [k for k in store['assays'] if k != 'exprs'] if 'assays' in store else []
+    if chunked:
+        all_features = pd.Index(store[exprs + '_features'].values)
+        all_samples = pd.Index(store[exprs + '_samples'].values)
+    elif table:
+        all_features = pd.Index(store.select_column(exprs, 'index'))
+        all_samples = store.select(exprs, start=0, stop=0).columns
+    else:
+        hdf_exprs = store[exprs]
+        all_features, all_samples = hdf_exprs.index, hdf_exprs.columns
+    features = _select_labels(all_features, hdf_fData, features, fQuery)
+    samples = _select_labels(all_samples, hdf_pData, samples, pQuery)
+    selected = not (isinstance(features, slice) and isinstance(samples, slice))
+    if table:
+        where = None
+        if not isinstance(features, slice):
+            rows = _positions(all_features, features)
+            order = np.argsort(rows, kind='mergesort')
+            where = rows[order]  # row coordinates, in the order stored
+        columns = None if isinstance(samples, slice) else list(samples)  # dropped after reading the rows
+        read = lambda key: store.select(key, where=where, columns=columns)
+        if where is not None:
+            read = lambda key, read=read: read(key).iloc[np.argsort(order, kind='mergesort')]
+        hdf_exprs = read(exprs)
+        hdf_assays = [(name, read(_assay_key(name))) for name in names]
+    elif not chunked:
+        read = lambda key: store[key].loc[features, samples] if selected else store[key]
+        hdf_exprs = hdf_exprs.loc[features, samples] if selected else hdf_exprs
+        hdf_assays = [(name, read(_assay_key(name))) for name in names]
     if verbose:
         print "Loading dataframes from", HDF5
         print store
     store.close()
-    return ExpressionSet(hdf_exprs, hdf_fData, hdf_pData, **hdf_meta)
+    hdf_fData = hdf_fData if not hdf_fData.empty else None
+    hdf_pData = hdf_pData if not hdf_pData.empty else None
+    if chunked:
+        h5 = tables.open_file(HDF5, 'r')
+        eSet = LazyExpressionSet(h5.get_node('/' + exprs), all_features, all_samples, hdf_fData, hdf_pData, **hdf_meta)
+        for name in names:
+            eSet._assays[name] = h5.get_node('/' + _assay_key(name))  # stays on disk
+        if not selected:
+            return eSet
+        sub = eSet.subset(features, samples)  # reads only the chunks needed
+        eSet.close()
+        return sub
+    hdf_fData = hdf_fData.loc[features] if hdf_fData is not None else None
+    hdf_pData = hdf_pData.loc[samples]  if hdf_pData is not None else None
+    eSet = ExpressionSet(hdf_exprs, hdf_fData, hdf_pData, **hdf_meta)
+    for name, df in hdf_assays:
+        eSet.set_assay(name, df)
+    return eSet
+
+def Binary2ExpressionSet(path, mmap_mode='r', verbose=True):
+    """Read a binary directory (see ExpressionSet2Binary) into ExpressionSet.
+
+    path: the input directory.
+    mmap_mode: 'r' (read-only), 'r+', or 'c' (copy-on-write) to memory-map exprs.npy,
+               or None to read it into memory.
+
+    A memory-mapped exprs is not read until used: loading takes about the same
+    time regardless of its size, and processes mapping the same file share its pages.
+    Other assays (assay_<name>.npy) are memory-mapped (or read) in the same way.
+
+    Return a LazyExpressionSet object backed by the memory map, or an ExpressionSet
+    object if mmap_mode is None.
+    """
+    import numpy as np
+    array = np.load(os.path.join(path, 'exprs.npy'), mmap_mode=mmap_mode)
+    index = pd.read_pickle(os.path.join(path, 'index.pkl'))
+    meta = pd.read_pickle(os.path.join(path, 'meta.pkl'))
+    meta['source'] = path
+    fData = _read_frame(path, 'fData')
+    pData = _read_frame(path, 'pData')
+    if verbose:
+        print "Loading eSet from", path
+    if mmap_mode is not None:
+        eSet = LazyExpressionSet(array, index['features'], index['samples'], fData, pData, **meta)
+    else:
+        exprs = pd.DataFrame(array, index=index['features'], columns=index['samples'], copy=False)
+        eSet = ExpressionSet(exprs, fData, pData, **meta)
+    for name in index.get('assays', []):
+        eSet.set_assay(name, np.load(os.path.join(path, _assay_key(name) + '.npy'), mmap_mode=mmap_mode))
+    return eSet
 
 # ================================================================================
 # Output functions
 # ================================================================================
 
 def ExpressionSet2RData(eSet, RData, verbose=True):
-    """Write ExpressionSet to RData as a single-assay ExpressionSet object
+    """Write ExpressionSet to RData as an ExpressionSet object
 
     eSet:  A omics ExpressionSet object
     RData: Output RData filename
 
-    Note: Mutiple assay data currently not supported in this version.
-    Todo: Support multiple expresion matrixes into assayData.
+    Every assay (derived assays computed) is saved as a matrix in assayData.
     """
+    r, pandas2ri, importr = _rpy2()
     importr('Biobase')
-    r.assign("exprs", eSet.exprs)
+    matrices = []
+    for i, name in enumerate(eSet.assays):
+        r.assign("assay%d" % i, eSet.assay(name))
+        matrices.append("`{}`=as.matrix(assay{})".format(name, i))
     r.assign("fdata", eSet.fData)
     r.assign("pdata", eSet.pData)
     r.assign("rdata", RData)
-    r("eSet = ExpressionSet(assayData=as.matrix(exprs), \
+    r("eSet = ExpressionSet(assayData=assayDataNew(" + ", ".join(matrices) + "), \
                             featureData=AnnotatedDataFrame(fdata), \
                             phenoData=AnnotatedDataFrame(pdata))")
     r("save(eSet, file=rdata)")
@@ -167,21 +470,79 @@ def ExpressionSet2RData(eSet, RData, verbose=True):
         print "Saving eSet to", RData
         print r.eSet
 
-def ExpressionSet2HDF5(eSet, HDF5, verbose=True):
+def ExpressionSet2HDF5(eSet, HDF5, format='fixed', chunkshape=None, complevel=5, complib='blosc', verbose=True):
     """Write ExpressionSet to HDF5 as a buch of Pandas dataframes
 
     eSet:  A omics ExpressionSet object
     HDF5: Output HDF5 filename
-
-    Note: Mutiple assay data currently not supported in this version.
-    Todo: Support multiple expresion matrixes into assayData.
+    format: 'fixed' to store exprs as a Pandas dataframe,
+            'table' to store exprs as a PyTables table, whose rows (features) can be
+            read selectively (see HDF52ExpressionSet; samples cannot), or
+            'chunked' to store exprs as a chunked and compressed matrix,
+            which is read back lazily as a LazyExpressionSet.
+    chunkshape: (features, samples) per chunk, for the chunked format (default: up to 256 x 256).
+    complevel, complib: compression level and library, for the chunked format.
+
+    Other assays (derived assays computed) are saved in the same format as
+    'assay_<name>', and their names as the series 'assays'.
     """
     store = pd.HDFStore(HDF5)
-    store['exprs'] = eSet.exprs
+    for name in eSet.assays:
+        if format == 'table':
+            store.put(_assay_key(name), eSet.assay(name), format='table')
+        elif format != 'chunked':
+            store[_assay_key(name)] = eSet.assay(name)
+    if len(eSet.assays) > 1: store['assays'] = pd.Series(eSet.assays)
     if not eSet.fData.empty: store.append('fData', eSet.fData)
     if not eSet.pData.empty: store.append('pData', eSet.pData)
     if not eSet.meta.empty:  store.append('meta',  eSet.meta)
+    store.close()
+    if format == 'chunked':
+        for name in eSet.assays:
+            _write_chunked_exprs(eSet, HDF5, _assay_key(name), chunkshape, complevel, complib, assay=name)
     if verbose:
         print "Saving eSet dataframes to", HDF5
+        store = pd.HDFStore(HDF5)
         print store
-    store.close()
+        store.close()
+
+def ExpressionSet2Binary(eSet, path, dtype=None, size=1024, verbose=True):
+    """Write ExpressionSet to a binary directory (see Binary2ExpressionSet).
+
+    eSet: A omics ExpressionSet (or LazyExpressionSet) object
+    path: Output directory (created if needed)
+    dtype: dtype of the saved exprs, e.g., 'float32' (default: the dtype of exprs)
+    size: number of features written per block
+
+    exprs is written block by block into a memory-mapped .npy file, and so is
+    every other assay (derived assays computed) as assay_<name>.npy.
+    Feature and sample names, and metadata, are pickled so their types round-trip.
+    """
+    import numpy as np
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    shape = (len(eSet.features), len(eSet.samples))
+    for name in eSet.assays:
+        blocks = _iter_assay_blocks(eSet, name, size)
+        block = next(blocks, None)  # None if there are no features
+        array = np.lib.format.open_memmap(os.path.join(path, _assay_key(name) + '.npy'), mode='w+',
+                                          dtype=np.dtype(dtype or (block.values.dtype if block is not None else 'float64')),
+                                          shape=shape)
+        i = 0
+        while block is not None:
+            array[i:i+len(block)] = block.values
+            i += len(block)
+            block = next(blocks, None)
+        array.flush()
+        del array
+    pd.to_pickle({'features': eSet.features, 'samples': eSet.samples, 'assays': eSet.assays[1:]},
+                 os.path.join(path, 'index.pkl'))
+    pd.to_pickle(dict(eSet.meta), os.path.join(path, 'meta.pkl'))  # source is reset to path on reading
+    for name, df in (('fData', eSet.fData), ('pData', eSet.pData)):
+        for ext in ('.parquet', '.pkl'):
+            if os.path.exists(os.path.join(path, name + ext)):
+                os.remove(os.path.join(path, name + ext))  # stale from a previous save
+        if not df.empty:
+            _write_frame(df, path, name)
+    if verbose:
+        print "Saving eSet to", path
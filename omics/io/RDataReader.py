@@ -0,0 +1,451 @@
+"""Pure-Python reader of R's serialization format (RDS and RData files).
+
+No R installation (or rpy2) is needed. Supported:
+  * gzip, bzip2, xz compressed (or uncompressed) files
+  * XDR (default) and native binary formats, serialization versions 2 and 3
+  * atomic vectors, lists, pairlists, symbols, environments, S4 objects,
+    references, and the ALTREP classes R writes for compact sequences,
+    deferred strings, and wrappers
+
+Numeric vectors are read straight into NumPy buffers (no intermediate copies),
+so a large expression matrix costs a single allocation.
+
+Input:
+  * read_rds(path): the R object in an RDS file
+  * read_rdata(path): a name-to-object dict of the R objects in an RData file
+  * is_rdata(path): whether a file is RData (save) rather than RDS (saveRDS)
+
+R objects are returned as RObject instances; as_pandas(obj) converts vectors,
+factors, matrices, and data.frames into NumPy/Pandas objects.
+
+Note: bytecode (compiled closures) and the ASCII format are not supported.
+
+Reference:
+  * https://github.com/wch/r-source/blob/trunk/src/main/serialize.c
+"""
+import bz2
+import gzip
+import struct
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+__author__ = "Cho-Yi Chen"
+__version__ = "2016.10.16"
+
+# SEXP types
+NILSXP, SYMSXP, LISTSXP, CLOSXP, ENVSXP, PROMSXP, LANGSXP = 0, 1, 2, 3, 4, 5, 6
+SPECIALSXP, BUILTINSXP, CHARSXP, LGLSXP, INTSXP, REALSXP = 7, 8, 9, 10, 13, 14
+CPLXSXP, STRSXP, DOTSXP, VECSXP, EXPRSXP, BCODESXP = 15, 16, 17, 19, 20, 21
+EXTPTRSXP, WEAKREFSXP, RAWSXP, S4SXP = 22, 23, 24, 25
+
+# Pseudo SEXP types used by the serialization format
+ALTREP_SXP, ATTRLISTSXP, ATTRLANGSXP = 238, 239, 240
+BASEENV_SXP, EMPTYENV_SXP = 241, 242
+GENERICREFSXP, CLASSREFSXP, PERSISTSXP, PACKAGESXP, NAMESPACESXP = 245, 246, 247, 248, 249
+BASENAMESPACE_SXP, MISSINGARG_SXP, UNBOUNDVALUE_SXP = 250, 251, 252
+GLOBALENV_SXP, NILVALUE_SXP, REFSXP = 253, 254, 255
+
+NA_INTEGER = np.iinfo(np.int32).min
+
+_TYPE_NAMES = {
+    NILSXP: 'NULL', SYMSXP: 'symbol', LISTSXP: 'pairlist', CLOSXP: 'closure',
+    ENVSXP: 'environment', PROMSXP: 'promise', LANGSXP: 'language',
+    SPECIALSXP: 'special', BUILTINSXP: 'builtin', CHARSXP: 'char', LGLSXP: 'logical',
+    INTSXP: 'integer', REALSXP: 'double', CPLXSXP: 'complex', STRSXP: 'character',
+    DOTSXP: '...', VECSXP: 'list', EXPRSXP: 'expression', EXTPTRSXP: 'externalptr',
+    WEAKREFSXP: 'weakref', RAWSXP: 'raw', S4SXP: 'S4',
+    PACKAGESXP: 'package', NAMESPACESXP: 'namespace', PERSISTSXP: 'persistent',
+    BASEENV_SXP: 'baseenv', EMPTYENV_SXP: 'emptyenv', GLOBALENV_SXP: 'globalenv',
+    BASENAMESPACE_SXP: 'basenamespace', MISSINGARG_SXP: 'missingarg',
+    UNBOUNDVALUE_SXP: 'unboundvalue',
+}
+
+class RObject(object):
+    """An R object.
+
+    type: R's type name, e.g., 'double', 'character', 'list', 'environment', or 'S4'
+    value: a NumPy array (atomic vectors), a list (lists, pairlists, and language objects),
+           a name-to-object dict (environments), a string (symbols), or None
+    attributes: an ordered name-to-object dict of R attributes (or S4 slots)
+    tags: names of the elements of a pairlist (or None)
+    """
+    __slots__ = ('type', 'value', 'attributes', 'tags')
+
+    def __init__(self, type, value=None, attributes=None, tags=None):
+        self.type = type
+        self.value = value
+        self.attributes = attributes if attributes is not None else OrderedDict()
+        self.tags = tags
+
+    def __repr__(self):
+        classes = self.classes
+        return '<RObject {}{}{}>'.format(self.type, ' ' + '/'.join(classes) if classes else '',
+                                        ' of length {}'.format(len(self.value)) if hasattr(self.value, '__len__') else '')
+
+    def attr(self, name, default=None):
+        """Return an attribute (or an S4 slot) value."""
+        obj = self.attributes.get(name)
+        return default if obj is None else obj
+
+    @property
+    def classes(self):
+        """The class attribute as a list of strings."""
+        obj = self.attributes.get('class')
+        return [] if obj is None else list(obj.value)
+
+    def inherits(self, name):
+        return name in self.classes
+
+# ================================================================================
+# Stream readers
+# ================================================================================
+
+def _open(path):
+    """Open a (compressed) R file by its magic number."""
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    if magic.startswith(b'\x1f\x8b'):
+        return gzip.open(path, 'rb')
+    if magic.startswith(b'BZh'):
+        return bz2.BZ2File(path, 'rb')
+    if magic.startswith(b'\xfd7zXZ\x00'):
+        try:
+            import lzma
+        except ImportError:
+            from backports import lzma  # Python 2: pip install backports.lzma
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+class _Stream(object):
+    """Read integers, doubles, and bytes from a serialized R stream."""
+    def __init__(self, f, big_endian=True):
+        self.f = f
+        self._int = struct.Struct('>i' if big_endian else '<i')
+        self.int32 = np.dtype('>i4' if big_endian else '<i4')
+        self.float64 = np.dtype('>f8' if big_endian else '<f8')
+
+    def bytes(self, n):
+        data = self.f.read(n)
+        if len(data) != n:
+            raise EOFError('Unexpected end of R serialization stream.')
+        return data
+
+    def int(self):
+        return self._int.unpack(self.bytes(4))[0]
+
+    def array(self, dtype, n, blocksize=1 << 24):
+        """Read n items of dtype into a new native-endian array."""
+        out = np.empty(n, dtype=dtype)
+        buf = memoryview(out.view(np.uint8))
+        readinto = getattr(self.f, 'readinto', None)
+        i, nbytes = 0, out.nbytes
+        while i < nbytes:
+            j = min(i + blocksize, nbytes)
+            if readinto is not None:
+                k = readinto(buf[i:j])
+            else:
+                data = self.f.read(j - i)
+                k = len(data)
+                buf[i:i+k] = data
+            if not k:
+                raise EOFError('Unexpected end of R serialization stream.')
+            i += k
+        if not out.dtype.isnative:
+            out = out.byteswap(True).view(out.dtype.newbyteorder())
+        return out
+
+    def length(self):
+        n = self.int()
+        if n == -1:  # long vector
+            upper, lower = self.int(), self.int()
+            n = (upper << 32) + (lower & 0xFFFFFFFF)
+        return n
+
+class _Unserializer(object):
+    """Rebuild R objects from a serialized R stream (see R's serialize.c)."""
+    def __init__(self, f):
+        fmt = f.read(2)
+        if fmt == b'X\n':
+            self.stream = _Stream(f, big_endian=True)
+        elif fmt == b'B\n':
+            self.stream = _Stream(f, big_endian=sys.byteorder == 'big')
+        elif fmt == b'A\n':
+            raise NotImplementedError('The ASCII R serialization format is not supported.')
+        else:
+            raise ValueError('Not an R serialization stream.')
+        self.version = self.stream.int()
+        self.stream.int()  # writer R version
+        self.stream.int()  # minimal reader R version
+        self.encoding = 'utf-8'
+        if self.version == 3:
+            self.encoding = self.stream.bytes(self.stream.int()).decode('ascii').lower()
+            if self.encoding in ('', 'unknown'):
+                self.encoding = 'utf-8'
+        elif self.version != 2:
+            raise ValueError('Unsupported R serialization version: {}'.format(self.version))
+        self.refs = []
+
+    def read(self, flags=None):
+        s = self.stream
+        flags = s.int() if flags is None else flags
+        sxp = flags & 0xFF
+        levels = flags >> 12
+        has_attr = bool(flags & (1 << 9))
+        has_tag = bool(flags & (1 << 10))
+        if sxp == NILVALUE_SXP:
+            return None
+        if sxp in (EMPTYENV_SXP, BASEENV_SXP, GLOBALENV_SXP, UNBOUNDVALUE_SXP,
+                   MISSINGARG_SXP, BASENAMESPACE_SXP):
+            return RObject(_TYPE_NAMES[sxp])
+        if sxp == REFSXP:
+            i = flags >> 8
+            return self.refs[(i or s.int()) - 1]
+        if sxp in (PERSISTSXP, PACKAGESXP, NAMESPACESXP):
+            obj = RObject(_TYPE_NAMES[sxp], self._string_vector())
+            self.refs.append(obj)
+            return obj
+        if sxp == SYMSXP:
+            obj = RObject('symbol', self.read().value)  # a CHARSXP
+            self.refs.append(obj)
+            return obj
+        if sxp == ENVSXP:
+            locked = s.int()
+            obj = RObject('environment', OrderedDict())
+            self.refs.append(obj)  # before its contents, which may refer to it
+            enclos, frame, hashtab = self.read(), self.read(), self.read()
+            obj.attributes = self._attributes(self.read())
+            for pairlist in [frame] + (hashtab.value if hashtab is not None else []):
+                if pairlist is not None:
+                    obj.value.update(zip(pairlist.tags, pairlist.value))
+            obj.tags = {'enclos': enclos, 'locked': bool(locked)}
+            return obj
+        if sxp in (LISTSXP, LANGSXP, CLOSXP, PROMSXP, DOTSXP, ATTRLISTSXP, ATTRLANGSXP):
+            return self._pairlist(flags)
+        if sxp == ALTREP_SXP:
+            return self._altrep()
+        if sxp in (BCODESXP, CLASSREFSXP, GENERICREFSXP):
+            raise NotImplementedError('Unsupported R object type in the stream: {}'.format(sxp))
+        # Vectors and other objects with attributes
+        if sxp == CHARSXP:
+            n = s.int()
+            value = None if n == -1 else self._decode(s.bytes(n), levels)
+            if has_attr:
+                self.read()  # discarded
+            return RObject('char', value)
+        if sxp in (LGLSXP, INTSXP):
+            obj = RObject(_TYPE_NAMES[sxp], s.array(s.int32, s.length()))
+        elif sxp == REALSXP:
+            obj = RObject('double', s.array(s.float64, s.length()))
+        elif sxp == CPLXSXP:
+            parts = s.array(s.float64, 2 * s.length())
+            obj = RObject('complex', parts[0::2] + 1j * parts[1::2])
+        elif sxp == STRSXP:
+            n = s.length()
+            value = np.empty(n, dtype=object)
+            for i in xrange(n):
+                value[i] = self.read().value
+            obj = RObject('character', value)
+        elif sxp in (VECSXP, EXPRSXP):
+            obj = RObject(_TYPE_NAMES[sxp], [self.read() for i in xrange(s.length())])
+        elif sxp == RAWSXP:
+            obj = RObject('raw', np.frombuffer(s.bytes(s.length()), dtype=np.uint8))
+        elif sxp == S4SXP:
+            obj = RObject('S4')
+        elif sxp in (SPECIALSXP, BUILTINSXP):
+            obj = RObject(_TYPE_NAMES[sxp], s.bytes(s.int()).decode('ascii'))
+        elif sxp == EXTPTRSXP:
+            obj = RObject('externalptr')
+            self.refs.append(obj)
+            obj.value = [self.read(), self.read()]  # protected value, tag
+        elif sxp == WEAKREFSXP:
+            obj = RObject('weakref')
+            self.refs.append(obj)
+        else:
+            raise ValueError('Unknown R object type in the stream: {}'.format(sxp))
+        if has_attr:
+            obj.attributes = self._attributes(self.read())
+        return obj
+
+    def _decode(self, data, levels):
+        if levels & (1 << 1):  # bytes
+            return data
+        if levels & (1 << 2):  # latin1
+            return data.decode('latin1')
+        if levels & ((1 << 3) | (1 << 6)):  # utf-8 or ascii
+            return data.decode('utf-8')
+        return data.decode(self.encoding, 'replace')
+
+    def _string_vector(self):
+        if self.stream.int() != 0:
+            raise ValueError('Names in persistent strings are not supported.')
+        return [self.read().value for i in xrange(self.stream.int())]
+
+    def _attributes(self, pairlist):
+        if pairlist is None:
+            return OrderedDict()
+        return OrderedDict(zip(pairlist.tags, pairlist.value))
+
+    def _pairlist(self, flags):
+        """Read a pairlist (or a language object, closure, ...) iteratively along its CDRs."""
+        sxp = flags & 0xFF
+        sxp = {ATTRLISTSXP: LISTSXP, ATTRLANGSXP: LANGSXP}.get(sxp, sxp)
+        obj = RObject(_TYPE_NAMES[sxp], [], tags=[])
+        first = True
+        while True:
+            attributes = self.read() if flags & (1 << 9) else None
+            tag = self.read() if flags & (1 << 10) else None
+            if first:
+                obj.attributes = self._attributes(attributes)
+                first = False
+            obj.tags.append(tag.value if tag is not None else None)
+            obj.value.append(self.read())
+            flags = self.stream.int()
+            if flags & 0xFF not in (LISTSXP, ATTRLISTSXP):
+                cdr = self.read(flags)
+                if cdr is not None:  # a dotted pair: keep the CDR as the last element
+                    obj.tags.append(None)
+                    obj.value.append(cdr)
+                return obj
+
+    def _altrep(self):
+        """Rebuild a vector from an ALTREP class, its serialized state, and attributes."""
+        info, state, attributes = self.read(), self.read(), self.read()
+        name = info.value[0].value
+        if name in ('compact_intseq', 'compact_realseq'):
+            n, start, step = state.value[:3]
+            value = start + step * np.arange(int(n))
+            obj = (RObject('integer', value.astype(np.int32)) if name == 'compact_intseq'
+                   else RObject('double', value.astype(np.float64)))
+        elif name == 'deferred_string':
+            x = state.value[0]
+            if x.type == 'integer':
+                value = [None if i == NA_INTEGER else str(i) for i in x.value]
+            else:
+                value = [None if np.isnan(i) else '%.15g' % i for i in x.value]
+            obj = RObject('character', np.array(value, dtype=object))
+        elif name.startswith('wrap_'):
+            obj = RObject(state.value[0].type, state.value[0].value)
+        else:
+            raise NotImplementedError('Unsupported ALTREP class: {}'.format(name))
+        obj.attributes = self._attributes(attributes)
+        return obj
+
+# ================================================================================
+# Input functions
+# ================================================================================
+
+def read_rds(path):
+    """Read the R object in an RDS file (saveRDS).
+
+    Return an RObject (or None for NULL).
+    """
+    f = _open(path)
+    try:
+        return _Unserializer(f).read()
+    finally:
+        f.close()
+
+def is_rdata(path):
+    """Whether path is an RData file (save), by the magic number of its (decompressed) content."""
+    f = _open(path)
+    try:
+        return f.read(5) in (b'RDX2\n', b'RDX3\n')
+    finally:
+        f.close()
+
+def read_rdata(path):
+    """Read all R objects in an RData file (save).
+
+    Return an ordered name-to-RObject dict.
+    """
+    f = _open(path)
+    try:
+        magic = f.read(5)
+        if magic not in (b'RDX2\n', b'RDX3\n'):
+            raise ValueError('Not an RData file (or an unsupported ASCII one): {}'.format(path))
+        pairlist = _Unserializer(f).read()
+    finally:
+        f.close()
+    if pairlist is None:
+        return OrderedDict()
+    return OrderedDict(zip(pairlist.tags, pairlist.value))
+
+# ================================================================================
+# Conversion functions
+# ================================================================================
+
+def _vector(obj):
+    """NumPy array of an atomic vector (NA as NaN/None)."""
+    value = obj.value
+    if obj.type == 'logical':
+        na = value == NA_INTEGER
+        return np.where(na, np.nan, value) if na.any() else value.astype(bool)
+    if obj.type == 'integer':
+        na = value == NA_INTEGER
+        return np.where(na, np.nan, value) if na.any() else value
+    return value
+
+def _names(obj):
+    return None if obj is None else _vector(obj)
+
+def _factor(obj):
+    codes = np.where(obj.value == NA_INTEGER, 0, obj.value) - 1
+    return pd.Categorical.from_codes(codes, categories=list(obj.attr('levels').value),
+                                     ordered=obj.inherits('ordered'))
+
+def _row_names(obj, n):
+    """Row names of a data.frame (None for R's compact form, c(NA, -n))."""
+    if obj is None:
+        return None
+    if obj.type == 'integer' and len(obj.value) == 2 and obj.value[0] == NA_INTEGER:
+        return None
+    return _vector(obj)
+
+def as_pandas(obj):
+    """Convert an RObject into NumPy/Pandas objects where possible.
+
+    * factor -> Pandas Categorical
+    * data.frame -> Pandas DataFrame (factor columns as Categorical)
+    * matrix -> Pandas DataFrame (a column-major view of the R matrix, if no NAs to convert)
+    * atomic vector -> NumPy array (or Pandas Series if named)
+    * list, pairlist -> list (or an ordered dict if named)
+
+    Other objects (e.g., environments and S4 objects) are returned as they are.
+    """
+    if not isinstance(obj, RObject):
+        return obj
+    if obj.inherits('factor'):
+        return _factor(obj)
+    if obj.inherits('data.frame'):
+        names = list(obj.attr('names').value) if obj.attr('names') is not None else []
+        columns = [as_pandas(col) for col in obj.value]
+        n = len(columns[0]) if columns else 0
+        index = _row_names(obj.attr('row.names'), n)
+        if not columns and index is None:
+            row_names = obj.attr('row.names')
+            n = abs(int(row_names.value[1])) if row_names is not None and len(row_names.value) == 2 else 0
+        df = pd.DataFrame(OrderedDict(zip(names, columns)), columns=names,
+                          index=index if index is not None else pd.RangeIndex(n))
+        return df
+    if obj.type in ('logical', 'integer', 'double', 'complex', 'character', 'raw'):
+        dim = obj.attr('dim')
+        if dim is not None and len(dim.value) == 2:
+            values = _vector(obj).reshape(tuple(dim.value), order='F')
+            dimnames = obj.attr('dimnames')
+            rows, cols = dimnames.value if dimnames is not None else (None, None)
+            return pd.DataFrame(values, index=_names(rows), columns=_names(cols), copy=False)
+        names = obj.attr('names')
+        if names is not None:
+            return pd.Series(_vector(obj), index=_names(names))
+        return _vector(obj)
+    if obj.type in ('list', 'expression'):
+        values = [as_pandas(v) for v in obj.value]
+        names = obj.attr('names')
+        return OrderedDict(zip(names.value, values)) if names is not None else values
+    if obj.type == 'pairlist':
+        values = [as_pandas(v) for v in obj.value]
+        return OrderedDict(zip(obj.tags, values)) if any(obj.tags) else values
+    return obj
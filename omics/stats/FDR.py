@@ -1,36 +1,176 @@
 """Multiple test correction.
+
+Significant p-value thresholds:
+  * Bonferroni(P, alpha)
+  * Holm_threshold(P, alpha)
+  * FDR_BH_threshold(P, alpha)
+  * FDR_BY_threshold(P, alpha)
+  * FDR_BL_threshold(P, alpha)
+
+Adjusted p-values:
+  * p_adjust(P, method): 'bonferroni', 'holm', 'BH' (fdr_bh), or 'BY' (fdr_by)
+  * qvalue(P, lambda_): Storey's q-values
+
+P can be a vector of P-values, or a 2-D array of many tests x many contrasts, in
+which case every column is corrected separately in one call (thresholds are then
+returned per column). All computations are vectorized over sorted P-values.
+NaNs are treated as missing tests.
 """
+import numpy as np
+
 __version__ = '16.12.28'
 __author__ = 'Cho-Yi Chen'
 
+def _sort(P):
+    """Sort P-values of each column in ascending order (NaNs last).
+
+    Return a tuple: (sorted P-values as a 2-D array, sort order, number of tests per column, is P a vector).
+    """
+    P = np.asarray(P, dtype=float)
+    vector = P.ndim == 1
+    P = P[:, None] if vector else P
+    order = np.argsort(P, axis=0)
+    Ps = P[order, np.arange(P.shape[1])]
+    m = np.sum(~np.isnan(P), axis=0)
+    return Ps, order, m, vector
+
+def _unsort(Ps, order, vector):
+    """Put sorted values back to their original order (the inverse of _sort)."""
+    out = np.empty_like(Ps)
+    out[order, np.arange(Ps.shape[1])] = Ps
+    return out.ravel() if vector else out
+
+def _harmonic(m):
+    """Harmonic numbers 1 + 1/2 + ... + 1/m."""
+    from scipy.special import psi
+    return psi(np.asarray(m) + 1.) + np.euler_gamma
+
+def _ranks(n):
+    """Ranks 1, 2, ..., n as a column vector."""
+    return np.arange(1, n + 1, dtype=float)[:, None]
+
 def Bonferroni(P, alpha=0.05):
     """Return the Bonferroni threshold for a vector of P-values."""
-    return alpha / len(P)
+    m = np.sum(~np.isnan(np.asarray(P, dtype=float)), axis=0)
+    return 1. * alpha / m
+
+def Holm_threshold(P, alpha=0.05):
+    """Return the significant p-value threshold using Holm's step-down method.
+
+    P -- A sequence of P-values
+    alpha -- Significance level
+    """
+    Ps, order, m, vector = _sort(P)
+    with np.errstate(divide='ignore'):
+        crit = alpha / (m - _ranks(len(Ps)) + 1)
+    failed = Ps > crit  # P-values not rejected (NaNs never fail)
+    first = np.argmax(failed, axis=0)
+    threshold = np.where(failed.any(axis=0), crit[first, np.arange(Ps.shape[1])], alpha)
+    return threshold[0] if vector else threshold
 
 def FDR_BH_threshold(P, alpha=0.05):
     """Return the significant p-value threshold using Benjamini and Hochberg's method.
-    
+
     P -- A sequence of P-values
     alpha -- Significance level
+
+    P-values at most the threshold are those rejected by statsmodels' fdr_bh,
+    per column of a 2-D array:
+
+    >>> from statsmodels.stats.multitest import multipletests
+    >>> P = np.random.RandomState(1).rand(100, 4) ** 4
+    >>> reject = np.transpose([multipletests(P[:, j], alpha=0.05, method='fdr_bh')[0] for j in range(4)])
+    >>> ((P <= FDR_BH_threshold(P, 0.05)) == reject).all()
+    True
     """
-    Pr = sorted(P, reverse=True)
-    m = len(Pr)
-    for i in xrange(m):
-        threshold = alpha * (m-i) / m
-        if Pr[i] <= threshold:
-            return threshold
-    return threshold
+    Ps, order, m, vector = _sort(P)
+    crit = alpha * _ranks(len(Ps)) / m
+    passed = Ps <= crit  # NaNs never pass
+    last = len(Ps) - 1 - np.argmax(passed[::-1], axis=0)  # largest rank passed
+    threshold = np.where(passed.any(axis=0), crit[last, np.arange(Ps.shape[1])], 1. * alpha / m)
+    return threshold[0] if vector else threshold
+
+def FDR_BY_threshold(P, alpha=0.05):
+    """Return the significant p-value threshold using Benjamini and Yekutieli's method.
+
+    P -- A sequence of P-values
+    alpha -- Significance level
+    """
+    m = np.sum(~np.isnan(np.asarray(P, dtype=float)), axis=0)
+    return FDR_BH_threshold(P, alpha / _harmonic(m))
 
 def FDR_BL_threshold(P, alpha=0.05):
     """Return the significant p-value threshold using Benjamini and Liu's method.
-    
+
     P -- A sequence of P-values
     alpha -- Significance level
     """
-    Pr = sorted(P)
-    m = len(Pr)
-    for i in xrange(m):
-        threshold = alpha * m / ((m-i) ** 2)
-        if Pr[i] >= threshold:
-            return threshold
-    return threshold
+    Ps, order, m, vector = _sort(P)
+    i = _ranks(len(Ps)) - 1
+    with np.errstate(divide='ignore'):
+        crit = np.where(i < m, alpha * m / (m - i) ** 2, np.inf)
+    passed = Ps >= crit  # NaNs never pass
+    first = np.argmax(passed, axis=0)
+    threshold = np.where(passed.any(axis=0), crit[first, np.arange(Ps.shape[1])], 1. * alpha * m)
+    return threshold[0] if vector else threshold
+
+def p_adjust(P, method='BH'):
+    """Return adjusted P-values (like R's p.adjust).
+
+    P -- A sequence of P-values, or a 2-D array (tests x contrasts) adjusted per column
+    method -- 'bonferroni', 'holm', 'BH' (or 'fdr_bh'), or 'BY' (or 'fdr_by')
+
+    The same values as R's p.adjust:
+
+    >>> P = [0.001, 0.008, 0.039, 0.041, 0.042, 0.06, 0.074, 0.205]
+    >>> ['%.4f' % p for p in p_adjust(P, 'BH')]
+    ['0.0080', '0.0320', '0.0672', '0.0672', '0.0672', '0.0800', '0.0846', '0.2050']
+    >>> ['%.4f' % p for p in p_adjust(P, 'holm')]
+    ['0.0080', '0.0560', '0.2340', '0.2340', '0.2340', '0.2340', '0.2340', '0.2340']
+
+    and as statsmodels, per column of a 2-D array, with NaNs left out of the tests:
+
+    >>> from statsmodels.stats.multitest import multipletests
+    >>> P = np.random.RandomState(0).rand(200, 3) ** 3
+    >>> P[::7, 1] = np.nan
+    >>> methods = [('bonferroni', 'bonferroni'), ('holm', 'holm'), ('BH', 'fdr_bh'), ('BY', 'fdr_by')]
+    >>> ok = [~np.isnan(P[:, j]) for j in range(3)]
+    >>> all(np.allclose(p_adjust(P, m)[ok[j], j], multipletests(P[ok[j], j], method=sm)[1])
+    ...     for m, sm in methods for j in range(3))
+    True
+    >>> np.isnan(p_adjust(P, 'BH')[~ok[1], 1]).all()
+    True
+    """
+    Ps, order, m, vector = _sort(P)
+    k = _ranks(len(Ps))
+    if method == 'bonferroni':
+        adj = m * Ps
+    elif method == 'holm':
+        adj = np.maximum.accumulate((m - k + 1) * Ps, axis=0)
+    elif method in ('BH', 'fdr_bh', 'BY', 'fdr_by'):
+        adj = m / k * Ps
+        missing = np.isnan(adj)
+        adj[missing] = np.inf
+        adj = np.minimum.accumulate(adj[::-1], axis=0)[::-1]
+        adj[missing] = np.nan
+        if method in ('BY', 'fdr_by'):
+            adj *= _harmonic(m)
+    else:
+        raise ValueError("Unsupported method. Must be bonferroni, holm, BH, or BY.")
+    return _unsort(np.minimum(adj, 1), order, vector)
+
+def qvalue(P, lambda_=0.5):
+    """Return Storey's q-values and the estimated proportion of true null hypotheses (pi0).
+
+    P -- A sequence of P-values, or a 2-D array (tests x contrasts) adjusted per column
+    lambda_ -- Tuning parameter for the pi0 estimate: pi0 = #{p > lambda} / (m * (1 - lambda))
+    """
+    P = np.asarray(P, dtype=float)
+    m = np.sum(~np.isnan(P), axis=0)
+    with np.errstate(invalid='ignore'):
+        pi0 = np.minimum(1., np.sum(P > lambda_, axis=0) / (m * (1. - lambda_)))
+    return pi0 * p_adjust(P, 'BH'), pi0
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -3,25 +3,34 @@
 This module defines the following functions, based on scikit-learn:
 
 * MI(x, y): Get MI between two vectors. Choose the method automatically based on variable types of x and y.
-* MI_matrix(df): Get pair-wise MI matrixes from a feature dataframe.
+* MI_matrix(df, n_jobs=1): Get pair-wise MI matrixes from a feature dataframe (optionally with a process pool).
+* MI(x, y, method='binned') and MI_matrix(df, method='binned'): Use a fast histogram-based estimator instead.
 * MI2NMI(df): Transform MI matrix to normalized MI (NMI) matrix
 * MI2MID(df): Transform MI matrix to MI distance (MID) matrix
+* MI2NMI/MI2MID(df, inplace=False, dtype=None, condensed=False): Transform without extra copies, in float32, or to a condensed 1-D array
 
 Notes:
 Although H(X) = I(X;X) >= I(X;Y), in some cases here I(X;Y) might be a little bit larger than H(X) or H(Y) when one of X and Y is numeric variable. This is due to the randomness in the kernel density estimation procedure used in scikit-learn (k-nearest-neighbors).
+
+The binned estimator discretizes every numeric variable once (categorical variables keep their categories) and computes the plug-in MI from joint histograms (integer bincounts) of each pair. It is deterministic and much faster than k-nearest-neighbors for large feature sets, but its values depend on the number of bins. Its diagonal is exactly the entropy H(X), so MI2NMI/MI2MID and MRMR can consume its output as is.
 """
 import numpy as np
 import pandas as pd
 from sklearn.feature_selection import mutual_info_regression, mutual_info_classif
 
-def MI(x, y, random_state=None):
+def MI(x, y, random_state=None, method='knn', bins='auto', strategy='quantile'):
     """Get mutual information (MI)  between two pandas series.
 
     x,y: any numeric or categorical vectors.
+    method: 'knn' (scikit-learn) or 'binned' (see MI_matrix).
+    bins, strategy: discretization of numeric vectors for the 'binned' method.
 
     Return the mutual information between x and y.
 
     """
+    if method == 'binned':
+        df = pd.DataFrame({'x': x.values, 'y': y.values}, columns=['x', 'y'])
+        return MI_matrix(df, method='binned', bins=bins, strategy=strategy).iloc[0, 1]
     # pandas's category encodes nan as -1 using integer coding
     is_categorical = lambda x: x.dtype.name == 'category'
     if is_categorical(x) and is_categorical(y):
@@ -34,41 +43,176 @@ def MI(x, y, random_state=None):
         # both x and y are numeric
         return mutual_info_regression(x.values.reshape(-1, 1), y, discrete_features=False, random_state=random_state)[0]
 
-def MI_matrix(df, seed=None, verbose=False, debug=False):
+def _encode(df, out=None):
+    """Encode a dataframe into a float64 matrix (categorical variables as integer codes).
+
+    df: An n samples x k features dataframe.
+    out: An n x k float64 array to fill in (optional).
+
+    Return the encoded matrix and a boolean mask for categorical variables.
+    """
+    nrow, ncol = df.shape
+    X = np.empty((nrow, ncol)) if out is None else out
+    is_categorical = np.array([dtype.name == 'category' for dtype in df.dtypes])
+    for j in xrange(ncol):
+        x = df.iloc[:, j]
+        X[:, j] = x.cat.codes.values if is_categorical[j] else x.values
+    return X, is_categorical
+
+def _MI_column(X, i, is_categorical, seed):
+    """MIs between the i-th column and the i-th, (i+1)-th, ... columns of the encoded matrix X."""
+    if is_categorical[i]:
+        return mutual_info_classif(X[:, i:], X[:, i], discrete_features=is_categorical[i:], random_state=seed)
+    else:
+        return mutual_info_regression(X[:, i:], X[:, i], discrete_features=is_categorical[i:], random_state=seed)
+
+def _discretize(df, bins='auto', strategy='quantile'):
+    """Discretize every column of a dataframe into integer bin codes.
+
+    df: An n samples x k features dataframe.
+    bins: Number of bins for numeric variables, or 'auto' for sqrt(n / 5) bins.
+    strategy: 'quantile' for equal-frequency bins, or 'uniform' for equal-width bins.
+
+    Categorical variables keep their categories. Missing values form a bin of their own.
+
+    Return an n x k integer code matrix (codes of column j are 0, ..., nbins[j] - 1) and nbins.
+    """
+    nrow, ncol = df.shape
+    nbins = max(2, int(np.sqrt(nrow / 5.))) if bins == 'auto' else bins
+    codes = np.empty((nrow, ncol), dtype=np.int64)
+    for j in xrange(ncol):
+        x = df.iloc[:, j]
+        if x.dtype.name == 'category':
+            c = x.cat.codes.values + 1  # nan (-1) -> 0
+        else:
+            if strategy == 'quantile':
+                v = (x.rank(method='average') - 1) / x.count()  # ties fall into the same bin
+            elif strategy == 'uniform':
+                v = (x - x.min()) / (x.max() - x.min()) if x.max() > x.min() else x * 0
+            else:
+                raise ValueError("Unsupported strategy. Must be either quantile or uniform.")
+            c = np.floor(v.values * nbins).clip(0, nbins - 1) + 1
+            c[np.isnan(c)] = 0
+        codes[:, j] = np.unique(c, return_inverse=True)[1]  # relabel bins to 0, 1, ...
+    return codes, codes.max(axis=0) + 1
+
+def _entropy(counts, axis=-1):
+    """Plug-in entropy (in nats) of histogram counts along the given axis."""
+    p = 1. * counts / counts.sum(axis=axis, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        plogp = np.where(p > 0, p * np.log(p), 0)
+    return -plogp.sum(axis=axis)
+
+def _MI_matrix_binned(codes, nbins, verbose=False, block_size=2**24):
+    """Pair-wise plug-in MI matrix from integer bin codes.
+
+    codes: An n x k integer code matrix from _discretize.
+    nbins: Number of bins of each column.
+    block_size: Max number of (sample, pair) elements per bincount, to bound memory.
+
+    The joint histograms of column i against a block of columns are built by a single
+    np.bincount on offset codes: code_i * B + code_j + (B * B) * (j - j0).
+
+    Return a k x k MI matrix (numpy array).
+    """
+    nrow, ncol = codes.shape
+    B = int(nbins.max())
+    H = np.array([_entropy(np.bincount(codes[:, j])) for j in xrange(ncol)])
+    step = max(1, block_size // max(nrow, B * B))
+    mat = np.zeros((ncol, ncol))
+    for i in xrange(ncol):
+        if verbose and i % 100 == 0: print "Computing MI of feature %d / %d ..." % (i + 1, ncol)
+        base = codes[:, i:i+1] * B
+        for j0 in xrange(i, ncol, step):
+            j1 = min(ncol, j0 + step)
+            idx = base + codes[:, j0:j1] + (B * B) * np.arange(j1 - j0)
+            counts = np.bincount(idx.ravel(), minlength=(j1 - j0) * B * B).reshape(j1 - j0, B * B)
+            mat[i, j0:j1] = H[i] + H[j0:j1] - _entropy(counts)
+    mat.T[np.triu_indices(ncol)] = mat[np.triu_indices(ncol)]  # fill-in the lower triangle
+    return mat
+
+_shared = {}  # per-worker view of the shared encoded matrix
+
+def _init_worker(buf, shape, is_categorical, seed, names=None):
+    _shared['X'] = np.frombuffer(buf).reshape(shape)
+    _shared['is_categorical'] = is_categorical
+    _shared['seed'] = seed
+    _shared['names'] = names  # column names to print (debug), or None
+
+def _MI_block(cols):
+    X, is_categorical, seed, names = _shared['X'], _shared['is_categorical'], _shared['seed'], _shared['names']
+    out = []
+    for i in cols:
+        if names is not None:
+            print names[i]
+        out.append((i, _MI_column(X, i, is_categorical, seed)))
+    return out
+
+def MI_matrix(df, seed=None, verbose=False, debug=False, n_jobs=1, method='knn', bins='auto', strategy='quantile'):
     """Compute a pair-wise mutual information matrix from a dataframe.
 
     df: An n samples x k features dataframe.
     seed: Seed for random number generator.
     verbose: To print out log message or not.
+    debug: To print out the name of each feature before computing its MI (by the
+           worker processes, in no particular order, if n_jobs > 1).
+    n_jobs: Number of worker processes (-1 for all CPUs). The encoded matrix is
+            placed in shared memory once, and blocks of columns are scheduled
+            across the workers. Given a seed, the result is identical to n_jobs=1.
+            Only used by 'knn': the 'binned' estimator runs vectorized in one process.
+    method: 'knn' for scikit-learn's k-nearest-neighbors estimator, or
+            'binned' for the histogram-based estimator (see module Notes).
+    bins: Number of bins for numeric variables ('binned' only), or 'auto' for sqrt(n / 5) bins.
+    strategy: 'quantile' (equal-frequency) or 'uniform' (equal-width) bins ('binned' only).
 
     Return a k x k dataframe matrix.
     """
-    df = df.copy()  # make a copy
+    from multiprocessing import Pool, cpu_count
+    from multiprocessing.sharedctypes import RawArray
     nrow, ncol = df.shape  # row: samples, col: variables
     if verbose: print "Input dataframe: %d samples x %d features" % (nrow, ncol)
+    if method == 'binned':
+        codes, nbins = _discretize(df, bins=bins, strategy=strategy)
+        if verbose: print "Discretized into %d - %d bins per feature" % (nbins.min(), nbins.max())
+        mat = _MI_matrix_binned(codes, nbins, verbose=verbose)
+        return pd.DataFrame(mat, index=df.columns, columns=df.columns)
+    n_jobs = cpu_count() if n_jobs < 0 else n_jobs
 
-    # get a boolean mask for categorical varialbes
-    is_categorical = df.columns.isin(df.select_dtypes(['category']).columns)
+    # do integer encoding for categorical variables (in shared memory if parallel)
+    if n_jobs > 1:
+        buf = RawArray('d', nrow * ncol)
+        X, is_categorical = _encode(df, out=np.frombuffer(buf).reshape(nrow, ncol))
+    else:
+        X, is_categorical = _encode(df)
     if verbose: print "%d features are categorical" % sum(is_categorical)
 
-    # do integer encoding for categorical variables
-    for i,x in df.select_dtypes(['category']).iteritems():
-        df[i] = x.cat.codes.astype('float64')
-
     # calculate pair-wise MI
     if verbose: print "Computing pair-wise MI ..."
-    out = []
-    for i in xrange(ncol):
-        #if verbose: print df.columns[i],
-        X = df.iloc[:, i:]  # feature matrix
-        y = df.iloc[:, i]   # target variable
-        if debug:
-            print y.name
-        if is_categorical[i]:
-            out.append(mutual_info_classif(X, y, discrete_features=is_categorical[i:], random_state=seed))
+    out = [None] * ncol
+    if n_jobs > 1:
+        # strided blocks of columns have balanced workloads (column i costs k - i)
+        nblocks = min(ncol, n_jobs * 8)
+        blocks = [range(b, ncol, nblocks) for b in xrange(nblocks)]
+        names = list(df.columns) if debug else None
+        pool = Pool(n_jobs, _init_worker, (buf, (nrow, ncol), is_categorical, seed, names))
+        try:
+            for k, result in enumerate(pool.imap_unordered(_MI_block, blocks)):
+                for i, mi in result:
+                    out[i] = mi
+                if verbose: print "Finished %d / %d blocks" % (k + 1, nblocks)
+        except BaseException:
+            pool.terminate()  # do not wait for the remaining blocks
+            raise
         else:
-            out.append(mutual_info_regression(X, y, discrete_features=is_categorical[i:], random_state=seed))
-    MIs = np.concatenate(out) 
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        for i in xrange(ncol):
+            if debug:
+                print df.columns[i]
+            out[i] = _MI_column(X, i, is_categorical, seed)
+    MIs = np.concatenate(out)
 
     # fill-in a square MI matrix
     mat = np.zeros((ncol, ncol))
@@ -77,38 +221,72 @@ def MI_matrix(df, seed=None, verbose=False, debug=False):
 
     return pd.DataFrame(mat, index=df.columns, columns=df.columns)
 
-def MI2NMI(df):
+def _transform(df, func, clip, inplace=False, dtype=None, condensed=False, block=256):
+    """Apply an element-wise transform func(mat_ij, mat_ii, mat_jj) to a square MI matrix.
+
+    Rows are processed in blocks by broadcasting, so at most a block x n temporary is allocated.
+
+    Return a transformed dataframe, or a condensed 1-D array if condensed is True.
+    """
+    mat = df.values
+    dtype = np.dtype(dtype) if dtype is not None else mat.dtype
+    d = np.diag(mat).astype(dtype)  # a copy, kept intact when mat is overwritten
+    n = len(d)
+    if condensed:
+        # upper triangle without the diagonal, row by row (see scipy.spatial.distance.squareform)
+        out = np.empty(n * (n - 1) // 2, dtype=dtype)
+        pos = 0
+        for i in xrange(n - 1):
+            out[pos:pos+n-i-1] = func(mat[i, i+1:], d[i], d[i+1:])
+            pos += n - i - 1
+        clip(out)
+        return out
+    if inplace:
+        if dtype != mat.dtype:
+            raise ValueError("Cannot change dtype in place.")
+        out = mat
+    else:
+        out = np.array(mat, dtype=dtype)
+    for i in xrange(0, n, block):
+        out[i:i+block] = func(out[i:i+block], d[i:i+block, None], d[None, :])
+    clip(out)
+    return pd.DataFrame(out, index=df.index, columns=df.columns, copy=False)
+
+def MI2NMI(df, inplace=False, dtype=None, condensed=False):
     """Transform the input MI matrix to a normalized MI matrix.
 
     df: an MI matrix (squared matrix, n x n features)
+    inplace: overwrite the values of df instead of allocating a new n x n matrix
+             (df must hold a single float dtype, so that df.values is a view).
+    dtype: output dtype, e.g., np.float32 (default: same as df).
+    condensed: return the upper triangle (without the diagonal) as a 1-D array,
+               in the condensed form of scipy.spatial.distance.squareform.
 
     Return a normalized MI (NMI) matrix. NMI is bounded by [0,1].
 
     Ref: https://en.wikipedia.org/wiki/Mutual_information#Normalized_variants
     """
-    n = df.shape[0]
-    mat = df.values
-    mat2 = np.zeros((n, n))
-    for i,j in np.dstack(np.triu_indices(n))[0]:
-        mat2[i, j] = mat2[j, i] = mat[i, j] / np.sqrt(mat[i, i] * mat[j, j])  # normalized MI
-    mat2[mat2 > 1] = 1  # fix precision error, see module Notes
-    return pd.DataFrame(mat2, index=df.index, columns=df.columns)
+    nmi = lambda mij, mii, mjj: mij / np.sqrt(mii * mjj)  # normalized MI
+    clip = lambda out: np.minimum(out, 1, out=out)  # fix precision error, see module Notes
+    return _transform(df, nmi, clip, inplace=inplace, dtype=dtype, condensed=condensed)
 
-def MI2MID(df):
+def MI2MID(df, inplace=False, dtype=None, condensed=False):
     """Transform the input MI matrix to a MI distance matrix.
     
     MI distance is defined as D(X,Y) =  1 - I(X,Y)/H(X,Y)
 
     df: an MI matrix (squared matrix, n x n features)
+    inplace: overwrite the values of df instead of allocating a new n x n matrix
+             (df must hold a single float dtype, so that df.values is a view).
+    dtype: output dtype, e.g., np.float32 (default: same as df).
+    condensed: return the upper triangle (without the diagonal) as a 1-D array,
+               in the condensed form of scipy.spatial.distance.squareform,
+               which can be passed to scipy.cluster.hierarchy.linkage directly.
 
     Return a MI distance (MID) matrix. MID is bounded by [0,1].
 
     Ref: https://en.wikipedia.org/wiki/Mutual_information#Metric
     """
-    n = df.shape[0]
-    mat = df.values
-    mat3 = np.zeros((n, n))
-    for i,j in np.dstack(np.triu_indices(n))[0]:
-        mat3[i, j] = mat3[j, i] = 1 - (mat[i, j] / (mat[i, i] + mat[j, j] - mat[i, j]))  # MI distance
-    mat3[mat3 < 0] = 0  # fix precision error, see module Notes
-    return pd.DataFrame(mat3, index=df.index, columns=df.columns)
+    mid = lambda mij, mii, mjj: 1 - (mij / (mii + mjj - mij))  # MI distance
+    clip = lambda out: np.maximum(out, 0, out=out)  # fix precision error, see module Notes
+    return _transform(df, mid, clip, inplace=inplace, dtype=dtype, condensed=condensed)
@@ -5,6 +5,7 @@ Wrappers of scikit-learn PCA functions and more:
 1. run_pca
 
 Run PCA/MDS/tSNE on the input dataframe and return the pca result and transformed dataframe.
+PCA can use a full, randomized, incremental (chunked), or sparse (truncated) SVD solver.
 
 2. plot_pca
 
@@ -19,7 +20,7 @@ Show the explained variance ratios of PCs in a barplot.
 
 4. pca_on_cov_matrix
 
-Run PCA on a covariance/correlation matrix.
+Run PCA (all or top k PCs) on a covariance/correlation matrix.
 """
 import numpy as np
 import pandas as pd
@@ -27,24 +28,55 @@ import pandas as pd
 __author__ =  "Cho-Yi (Joey) Chen"
 __version__ = "17.01.23"
 
-def run_pca(df, using="pca", pc=3, verbose=True):
+def run_pca(df, using="pca", pc=3, verbose=True, solver="auto", chunksize=1000):
     """Run sklearn's PCA on a sample-by-feature dataframe.
 
-    df: a dataframe where rows are samples (observations) and columns are features.
+    df: a dataframe where rows are samples (observations) and columns are features,
+        a scipy sparse matrix (samples-by-features), or an ExpressionSet (e.g., a
+        LazyExpressionSet) whose samples are streamed in chunks from eSet.iter_blocks.
     using: pca/mds/tsne
     pc: how many PCs you need
-    verbose: additional informaion output
-
-    Note: sklearn uses the LAPACK implementation of the full SVD.
-          This function doesn't rescale the input data by default.
+    verbose: additional informaion output, including time and peak memory usage
+    solver: PCA solver (using="pca" only):
+      * full: LAPACK full SVD
+      * randomized: randomized truncated SVD
+      * incremental: IncrementalPCA fed by chunks of samples (two passes: fit, transform)
+      * sparse: TruncatedSVD for sparse input (no centering)
+      * auto: sparse for sparse input, incremental for an ExpressionSet of more
+              than 2 ** 27 values (1 GB of doubles), randomized if pc < 80% of the
+              smaller dimension of a large (> 500) input, otherwise full.
+    chunksize: number of samples per chunk for the incremental solver.
+
+    Note: This function doesn't rescale the input data by default.
 
     Return a tuple: (sklearn's PCA object, transformed dataframe).
     """
-    from sklearn.decomposition import PCA
+    import time
+    from scipy import sparse
+    from sklearn.decomposition import PCA, IncrementalPCA, TruncatedSVD
     from sklearn.manifold import TSNE, MDS
+    start = time.time()
+    is_eset = hasattr(df, 'iter_blocks')
+    is_sparse = sparse.issparse(df)
+    shape = (len(df.samples), len(df.features)) if is_eset else df.shape
+    index = df.samples if is_eset else (range(shape[0]) if is_sparse else df.index)
     # choose from PCA, MDS or t-SNE
     if using == "pca":
-        pca = PCA(n_components=pc)
+        if solver == "auto":
+            if is_sparse:
+                solver = "sparse"
+            elif is_eset and shape[0] * shape[1] > 2 ** 27:
+                solver = "incremental"
+            elif max(shape) > 500 and pc < .8 * min(shape):
+                solver = "randomized"
+            else:
+                solver = "full"
+        if solver == "incremental":
+            pca = IncrementalPCA(n_components=pc)
+        elif solver == "sparse":
+            pca = TruncatedSVD(n_components=pc)
+        else:
+            pca = PCA(n_components=pc, svd_solver=solver)
     elif using == "mds":
         pca = MDS(n_components=pc)
     elif using == "tsne":
@@ -52,14 +84,33 @@ def run_pca(df, using="pca", pc=3, verbose=True):
     else:
         raise e, "Method %s not supported!" % using
     # run pca
-    mat = pca.fit_transform(df.values)
-    out = pd.DataFrame(mat, index=df.index, columns=['PC%d' % i for i in range(1, pc+1)])
+    if using == "pca" and solver == "incremental":
+        # evenly sized chunks, each with at least 2 * pc samples
+        n = shape[0]
+        size = int(np.ceil(1. * n / np.ceil(1. * n / max(chunksize, 2 * pc))))
+        if is_eset:
+            chunks = lambda: (block.T.values for block in df.iter_blocks(axis=1, size=size))
+        else:
+            chunks = lambda: (df.iloc[i:i+size].values for i in xrange(0, n, size))
+        for X in chunks():
+            pca.partial_fit(X)
+        mat = np.concatenate([pca.transform(X) for X in chunks()])
+    else:
+        X = df if is_sparse else (df.exprs.T.values if is_eset else df.values)
+        mat = pca.fit_transform(X)
+    out = pd.DataFrame(mat, index=index, columns=['PC%d' % i for i in range(1, pc+1)])
     # print meta info
     if verbose:
-        print "Data dimensions (samples-by-features):", df.shape
+        import resource
+        import sys
+        print "Data dimensions (samples-by-features):", shape
         if using == "pca":
+            print "Solver: %s" % solver
             print "Variance explained by top %d PCs:" % pc
             print ', '.join(["%.3g" % i for i in pca.explained_variance_ratio_])
+        print "Time elapsed: %.2f seconds" % (time.time() - start)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # in bytes on macOS, in KB elsewhere
+        print "Peak memory usage (process RSS): %.1f MB" % (maxrss / (1024. ** 2 if sys.platform == 'darwin' else 1024.))
     return pca, out
 
 def plot_2d_pca(pca, data, pData=None, hue=None, title=None, **kwargs):
@@ -192,28 +243,37 @@ def plot_explained_variance_ratio2(y, figsize=(4,3)):
     plt.legend(loc='best')
     plt.tight_layout()
 
-def pca_on_cov_matrix(mat):
+def pca_on_cov_matrix(mat, k=None):
     """PCA on covariance/correlation matrix.
 
     mat: can be covariance matrix, standardized covariance matrix, or correlation matrix.
+    k: number of top PCs to compute (default: all).
     
     The correlation matrix can be understood as the normalized covariance matrix.
 
-    Return: sorted (eigenvalue, eigenvector) list, explained variance ratio list, projection matrix W.
+    Since mat is symmetric, a symmetric eigensolver is used: LAPACK's eigh for all
+    PCs, or ARPACK's Lanczos solver (eigsh) for a few top PCs (k < n / 2), which
+    avoids the full decomposition.
+
+    Return: eigenvalues (sorted from high to low), explained variance ratio (%) of each PC,
+            projection matrix W (n x k, the i-th column is the eigenvector of the i-th PC).
 
     Note: Projection Onto the New Feature Space can be yieled by Y = X.dot(W), 
           where X is the raw samples x features matrix.
 
     Adapted from: http://sebastianraschka.com/Articles/2015_pca_in_3_steps.html
     """
-    eig_vals, eig_vecs = np.linalg.eig(mat)
-    # Make a list of (eigenvalue, eigenvector) tuples
-    eig_pairs = [(np.abs(eig_vals[i]), eig_vecs[:,i]) for i in range(len(eig_vals))]
-    # Sort the (eigenvalue, eigenvector) tuples from high to low
-    eig_pairs.sort(key=lambda x: x[0], reverse=True)
-    # Explained Variance
-    var_exp = [(i / sum(eig_vals)) * 100 for i in sorted(eig_vals, reverse=True)]
-    # Projection Matrix
+    mat = np.asarray(mat)
     n = mat.shape[0]
-    W = np.hstack([eig_vec.reshape(n, 1) for (eig_val, eig_vec) in eig_pairs])
-    return eig_pairs, var_exp, W
+    k = n if k is None else k
+    if k < n // 2:
+        from scipy.sparse.linalg import eigsh
+        eig_vals, eig_vecs = eigsh(mat, k=k, which='LA')
+    else:
+        eig_vals, eig_vecs = np.linalg.eigh(mat)
+    # Sort from high to low
+    order = np.argsort(eig_vals)[::-1][:k]
+    eig_vals, W = eig_vals[order], eig_vecs[:, order]
+    # Explained Variance (the sum of all eigenvalues is the trace)
+    var_exp = eig_vals / np.trace(mat) * 100
+    return eig_vals, var_exp, W
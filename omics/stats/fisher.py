@@ -1,12 +1,105 @@
 """Fisher's Exact test.
 
-Wrapper of scipy.stats.fisher_exact.
+Vectorized Fisher's exact test (hypergeometric test) on marginal numbers.
+Gives the same results as scipy.stats.fisher_exact, but many 2x2 tables can be
+tested in one call by passing arrays of marginal numbers.
 """
+import numpy as np
 
 __version__ = '16.11.16'
 __author__ = 'Cho-Yi Chen'
 
-def _test_by_marginal_numbers(a, b, c, d):
+_LOG_FACTORIAL = np.zeros(1)  # log(n!) for n = 0, 1, ..., extended on demand
+
+def _log_factorial(n):
+    """Return a lookup table of log(k!) for k = 0, 1, ..., (at least) n."""
+    global _LOG_FACTORIAL
+    if n >= len(_LOG_FACTORIAL):
+        from scipy.special import gammaln
+        size = max(n + 1, 2 * len(_LOG_FACTORIAL))
+        _LOG_FACTORIAL = gammaln(np.arange(size) + 1.)
+    return _LOG_FACTORIAL
+
+def _log_pmf(x, b, c, d, lf):
+    """Log hypergeometric probability of x hits, given marginal numbers b, c, d and a log(n!) table lf."""
+    return (lf[c] - lf[x] - lf[c-x] + lf[d-c] - lf[b-x] - lf[d-c-b+x]
+            - lf[d] + lf[b] + lf[d-b])
+
+def _sum_tail(pvalue, x, step, bound, b, c, d, i, lf, cutoff=None, eps=1e-20):
+    """Add hypergeometric probabilities of x, x+step, ... (until bound) to pvalue[i].
+
+    Every walk moves away from the mode, so the probabilities decrease and a walk
+    stops as soon as its next probability is negligible (< eps x the current p-value).
+    If cutoff is given, only probabilities <= cutoff are added (two-sided test).
+    """
+    while len(i):
+        lp = _log_pmf(x, b, c, d, lf)
+        add = lp <= cutoff if cutoff is not None else np.ones(len(i), dtype=bool)
+        pvalue[i] += np.where(add, np.exp(lp), 0.)
+        with np.errstate(divide='ignore'):
+            go = (x != bound) & (~add | (lp >= np.log(eps * pvalue[i])))
+        x, bound, b, c, d, i = [v[go] for v in (x + step, bound, b, c, d, i)]
+        if cutoff is not None:
+            cutoff = cutoff[go]
+
+def _test_by_marginal_arrays(a, b, c, d, alternative='two-sided'):
+    """Fisher's exact test by giving arrays of marginal numbers (see _test_by_marginal_numbers).
+
+    The P-values are sums of hypergeometric probabilities computed from a cached
+    log-factorial table. All tables are evaluated at once, walking each tail away
+    from the mode of the distribution until the remaining probabilities are negligible.
+
+    alternative: 'two-sided', 'greater' (enrichment), or 'less' (depletion).
+
+    Raise ValueError if any marginal numbers do not make a valid table.
+
+    Return arrays of odds ratios, p-values.
+    """
+    a, b, c, d = np.broadcast_arrays(*[np.asarray(i, dtype=np.int64) for i in (a, b, c, d)])
+    shape = a.shape
+    a, b, c, d = [i.ravel() for i in (a, b, c, d)]
+    lf = _log_factorial(int(d.max()) if d.size else 0)
+    lo = np.maximum(0, b + c - d)
+    hi = np.minimum(b, c)
+    invalid = (a < lo) | (a > hi) | (np.minimum(b, c) < 0) | (np.maximum(b, c) > d)
+    if invalid.any():
+        k = np.flatnonzero(invalid)[0]
+        raise ValueError("Invalid marginal numbers (a=%d, b=%d, c=%d, d=%d): "
+                         "need 0 <= b, c <= d and max(0, b+c-d) <= a <= min(b, c)" % (a[k], b[k], c[k], d[k]))
+    mode = np.clip((b + 1) * (c + 1) // (d + 2), lo, hi)
+    pvalue = np.zeros(len(a))
+    if alternative in ('greater', 'less'):
+        if alternative == 'greater':
+            step, bound, opposite, past = 1, hi, lo, a > mode
+        else:
+            step, bound, opposite, past = -1, lo, hi, a < mode
+        # in the tail: walk from a outward; otherwise: p = 1 - (the opposite tail)
+        i = np.flatnonzero(past | (a == mode))
+        _sum_tail(pvalue, a[i], step, bound[i], b[i], c[i], d[i], i, lf)
+        j = np.flatnonzero(~past & (a != mode))
+        k = j[a[j] != opposite[j]]  # the opposite tail is not empty
+        _sum_tail(pvalue, a[k] - step, -step, opposite[k], b[k], c[k], d[k], k, lf)
+        pvalue[j] = 1. - pvalue[j]
+    elif alternative == 'two-sided':
+        # the same relative tolerance as scipy.stats.fisher_exact
+        cutoff = _log_pmf(a, b, c, d, lf) + np.log1p(1e-7)
+        i = np.arange(len(a))
+        _sum_tail(pvalue, mode, -1, lo, b, c, d, i, lf, cutoff)
+        i = np.flatnonzero(mode < hi)
+        _sum_tail(pvalue, mode[i] + 1, 1, hi[i], b[i], c[i], d[i], i, lf, cutoff[i])
+    else:
+        raise ValueError("alternative should be 'two-sided', 'less' or 'greater'")
+    pvalue = np.clip(pvalue, 0., 1.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        den = 1. * (b - a) * (c - a)
+        oddsratio = np.where(den > 0, 1. * a * (d - b - c + a) / den, np.inf)
+    # tables with an empty row or column
+    empty = (b == 0) | (c == 0) | (b == d) | (c == d)
+    oddsratio[empty] = np.nan
+    pvalue[empty] = 1.
+    return oddsratio.reshape(shape), pvalue.reshape(shape)
+
+def _test_by_marginal_numbers(a, b, c, d, alternative='two-sided'):
     """Fisher's exact test by giving marginal numbers from a 2-dim contigency table:
 
     a     (b-a)    b
@@ -15,11 +108,10 @@ def _test_by_marginal_numbers(a, b, c, d):
 
     Return odds ratio, p-value.
     """
-    from scipy.stats import fisher_exact
-    oddsratio, pvalue = fisher_exact([[a, b-a], [c-a, d-b-c+a]])
-    return oddsratio, pvalue
+    oddsratio, pvalue = _test_by_marginal_arrays(a, b, c, d, alternative)
+    return oddsratio[()], pvalue[()]
 
-def _test_by_set_sizes(u, v, U, V):
+def _test_by_set_sizes(u, v, U, V, alternative='two-sided'):
     """Fisher's exact test by giving two sets.
 
     u, U: gene set u and its universe U
@@ -34,12 +126,14 @@ def _test_by_set_sizes(u, v, U, V):
     b = len(nu)
     c = len(nv)
     d = len(background)
-    return _test_by_marginal_numbers(a, b, c, d)
+    return _test_by_marginal_numbers(a, b, c, d, alternative)
 
-def fisher_exact_test(a, b, c, d, verbose=True):
+def fisher_exact_test(a, b, c, d, alternative='two-sided', verbose=True):
     """Fisher's exact test by giving marginal numbers or sets.
 
     If a, b, c, d, were numbers, they should represent marginal numbers in a contigency table.
+    If they were arrays of numbers, all the contigency tables are tested at once
+    (e.g., millions of gene set pairs) and arrays of odds ratios and p-values are returned.
 
     a     (b-a)    b
     (c-a) (d-b-c+a)
@@ -50,6 +144,10 @@ def fisher_exact_test(a, b, c, d, verbose=True):
     a, b: gene set a and its universe b
     c, d: gene set c and its universe d
 
+    alternative: 'two-sided', 'greater' (enrichment), or 'less' (depletion).
+    verbose: print the odds ratio and p-value (or, for arrays, the number of tables
+             and the smallest p-value).
+
     Return odds ratio, p-value.
 
     Examples:
@@ -74,18 +172,37 @@ def fisher_exact_test(a, b, c, d, verbose=True):
     Odds ratio: 20.00
     P-value: 3.50e-02
 
+    >>> odds, pval = fisher_exact_test([8, 5, 43], [10, 5, 45], [9, 6, 60], [16, 10, 69])
+    Tables: 3
+    Min P-value: 6.65e-03
+    >>> ['%.2e' % p for p in pval]
+    ['3.50e-02', '4.76e-02', '6.65e-03']
+
+    >>> fisher_exact_test(12, 10, 9, 16)
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid marginal numbers (a=12, b=10, c=9, d=16): need 0 <= b, c <= d and max(0, b+c-d) <= a <= min(b, c)
+
     References:
 
     * http://docs.scipy.org/doc/scipy-0.17.0/reference/generated/scipy.stats.fisher_exact.html
     * http://mathworld.wolfram.com/FishersExactTest.html
     * http://udel.edu/~mcdonald/statfishers.html
     """
-    if all([isinstance(i, int) for i in (a,b,c,d)]):
-        # call by giving four marginal numbers in a contigency table
-        oddsratio, pvalue =  _test_by_marginal_numbers(a,b,c,d)
     if all([isinstance(i, set) for i in (a,b,c,d)]):
         # call by giving two gene sets and their background sets
-        oddsratio, pvalue =  _test_by_set_sizes(a,b,c,d)
+        oddsratio, pvalue =  _test_by_set_sizes(a,b,c,d,alternative)
+    elif all([np.ndim(i) == 0 for i in (a,b,c,d)]):
+        # call by giving four marginal numbers in a contigency table
+        oddsratio, pvalue =  _test_by_marginal_numbers(a,b,c,d,alternative)
+    else:
+        # call by giving arrays of marginal numbers
+        oddsratio, pvalue = _test_by_marginal_arrays(a,b,c,d,alternative)
+        if verbose:
+            print "Tables: %d" % pvalue.size
+            if pvalue.size:
+                print "Min P-value: %.2e" % pvalue.min()
+        return oddsratio, pvalue
     if verbose:
         print "Odds ratio: %.2f" % oddsratio
         print "P-value: %.2e" % pvalue
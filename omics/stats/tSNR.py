@@ -1,6 +1,11 @@
 """Transcriptomic SNR (tSNR)
+
+* tsnr(X, Y): tSNR between two expression matrices.
+* tsnr_pval(X, Y): P value of tSNR by (batched, optionally parallel) permutations.
+* tsnr_groups(eSet, by): tSNRs between all pairs of sample groups of an ExpressionSet.
 """
 import numpy as np
+import pandas as pd
 
 __version__ = '16.12.28'
 __author__ = 'Cho-Yi Chen'
@@ -13,34 +18,170 @@ def tsnr(X, Y):
 
     Return the tSNR (float) between X and Y.
     """
-    # See http://docs.scipy.org/doc/scipy/reference/spatial.distance.html for more distance metrics
-    from scipy.spatial.distance import euclidean
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
     m = X.shape[1]
     n = Y.shape[1]
     xmean = X.mean(axis=1)
     ymean = Y.mean(axis=1)
-    signal = euclidean(xmean, ymean)
-    xvar = np.sum(np.square(np.apply_along_axis(euclidean, 0, X, xmean))) / (m - 1)
-    yvar = np.sum(np.square(np.apply_along_axis(euclidean, 0, Y, ymean))) / (n - 1)
+    signal = np.sqrt(np.sum(np.square(xmean - ymean)))  # euclidean distance between means
+    xvar = np.sum(np.square(X - xmean[:, None])) / (m - 1)
+    yvar = np.sum(np.square(Y - ymean[:, None])) / (n - 1)
     noise = np.sqrt((xvar / m) + (yvar / n))
     return 1. * signal / noise
 
-def tsnr_pval(X, Y, permute=1000):
+def _tsnr_permuted(Z, q, m, seed, size):
+    """tSNRs of a batch of random label permutations.
+
+    Z: pooled (gene-centered) expression matrix (genes-by-samples)
+    q: squared norms of the columns of Z
+    m: size of the case group
+    seed: seed of this batch
+    size: number of permutations in this batch
+
+    For each permutation, the group sums come from one matrix product with a
+    samples-by-permutations membership matrix, and the within-group sums of
+    squares from the precomputed squared norms q.
+
+    Return an array of tSNRs.
+    """
+    N = Z.shape[1]
+    n = N - m
+    rng = np.random.RandomState(seed)
+    cases = np.argsort(rng.rand(size, N), axis=1)[:, :m]  # case samples of each permutation
+    G = np.zeros((N, size))
+    G[cases, np.arange(size)[:, None]] = 1
+    xsum = Z.dot(G)
+    ysum = Z.sum(axis=1)[:, None] - xsum
+    xmean = xsum / m
+    ymean = ysum / n
+    signal = np.sqrt(np.sum(np.square(xmean - ymean), axis=0))
+    xvar = (q.dot(G) - m * np.sum(np.square(xmean), axis=0)) / (m - 1)
+    yvar = ((q.sum() - q.dot(G)) - n * np.sum(np.square(ymean), axis=0)) / (n - 1)
+    noise = np.sqrt((xvar / m) + (yvar / n))
+    return signal / noise
+
+_shared = {}  # per-worker pooled matrix
+
+def _init_worker(Z, q, m):
+    _shared['Z'], _shared['q'], _shared['m'] = Z, q, m
+
+def _permute_batch(args):
+    return _tsnr_permuted(_shared['Z'], _shared['q'], _shared['m'], *args)
+
+def _binomial_ci(k, n, ci):
+    """Clopper-Pearson confidence interval of a binomial proportion k / n."""
+    from scipy.stats import beta
+    a = (1. - ci) / 2
+    lo = beta.ppf(a, k, n - k + 1) if k > 0 else 0.
+    hi = beta.ppf(1 - a, k + 1, n - k) if k < n else 1.
+    return lo, hi
+
+def tsnr_pval(X, Y, permute=1000, seed=None, batch=100, n_jobs=1, alpha=None, ci=0.99):
     """Estimate the P value via permutation test.
+
+    X, Y: case/ctrl expression matrix (genes-by-samples)
+    permute: (max) number of permutations
+    seed: seed of the random permutations. Each batch gets its own seed drawn
+          from it, and batches are counted (and early stopping is checked after
+          each one) in seed order, so the result is reproducible regardless of n_jobs.
+    batch: number of permutations evaluated at once
+    n_jobs: number of worker processes (-1 for all CPUs)
+    alpha: if given, stop early once the confidence interval of the P value
+           lies entirely below or above alpha
+    ci: confidence level of the Clopper-Pearson interval used for early stopping
+
+    Return the P value (0.5 / permutations if no permuted tSNR reaches the observed one).
     """
+    from multiprocessing import Pool, cpu_count
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
     m = X.shape[1]
-    n = Y.shape[1]
     snr = tsnr(X, Y)
-    Z = np.concatenate([X,Y], axis=1).T
-    pool = []
-    for _ in xrange(permute):
-        np.random.shuffle(Z)
-        x = Z[:m,:].T
-        y = Z[m:,:].T
-        pool.append(tsnr(x, y))
-    pool = np.array(pool)
-    pval = 1. * sum(pool >= snr) / permute
-    return pval if pval != 0 else (0.5 / permute)
+    Z = np.concatenate([X, Y], axis=1)
+    Z = Z - Z.mean(axis=1)[:, None]  # centering doesn't change tSNR, but improves precision
+    q = np.sum(np.square(Z), axis=0)  # squared norms of samples
+    sizes = [min(batch, permute - i) for i in xrange(0, permute, batch)]
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=len(sizes))
+    jobs = zip(seeds, sizes)
+    n_jobs = cpu_count() if n_jobs < 0 else n_jobs
+    pool = Pool(n_jobs, _init_worker, (Z, q, m)) if n_jobs > 1 else None
+    if pool is None:
+        results = (_tsnr_permuted(Z, q, m, *job) for job in jobs)
+    else:
+        results = pool.imap(_permute_batch, jobs)  # in seed order
+    hits, done = 0, 0
+    try:
+        # the stopping rule is checked after every batch, in seed order
+        for pool_snr in results:
+            hits += np.sum(pool_snr >= snr)
+            done += len(pool_snr)
+            if alpha is not None:
+                lo, hi = _binomial_ci(hits, done, ci)
+                if hi < alpha or lo > alpha:
+                    break
+    except BaseException:
+        if pool is not None:
+            pool.terminate()  # do not wait for the remaining batches
+        raise
+    else:
+        if pool is not None:
+            pool.terminate()  # drop the batches computed ahead of an early stop
+    finally:
+        if pool is not None:
+            pool.join()
+    pval = 1. * hits / done
+    return pval if pval != 0 else (0.5 / done)
+
+def tsnr_groups(eSet, by, groups=None, permute=0, size=1024, **kwargs):
+    """All pair-wise tSNRs between sample groups of an ExpressionSet.
+
+    eSet: an ExpressionSet (or LazyExpressionSet)
+    by: a pData variable name that defines sample groups (e.g., 'SMTSD')
+    groups: groups to compare (default: all groups with at least 2 samples)
+    permute: if > 0, also estimate P values by tsnr_pval with this many permutations
+    size: number of features per block streamed from eSet
+    kwargs: passed to tsnr_pval, e.g., seed, n_jobs, alpha
+
+    Group means, within-group sums of squares, and inner products between group
+    means are accumulated once per group over blocks of features, so the tSNRs of
+    all pairs of groups come from a few k x k matrices (k groups).
+
+    Return a tidy dataframe with columns Group1, Group2, tSNR (and PValue).
+    """
+    from itertools import combinations
+    labels = eSet.pData[by]
+    if groups is None:
+        counts = labels.value_counts()
+        groups = sorted(counts.index[counts >= 2])
+    members = [np.flatnonzero((labels == g).values) for g in groups]
+    sizes = np.array([len(i) for i in members], dtype=float)
+    k = len(groups)
+    ss = np.zeros(k)         # within-group sums of squares
+    gram = np.zeros((k, k))  # inner products between group means
+    for block in eSet.iter_blocks(axis=0, size=size):
+        values = block.values.astype(float)
+        means = np.column_stack([values[:, i].mean(axis=1) for i in members])  # genes x groups
+        ss += [np.sum(np.square(values[:, i] - means[:, [j]])) for j, i in enumerate(members)]
+        means -= means.mean(axis=1)[:, None]  # centering doesn't change distances, but improves precision
+        gram += means.T.dot(means)
+    sq = np.diag(gram)
+    signal = np.sqrt((sq[:, None] + sq[None, :] - 2 * gram).clip(0))
+    noise = (ss / (sizes - 1)) / sizes
+    noise = np.sqrt(noise[:, None] + noise[None, :])
+    snr = signal / noise
+    if permute > 0:
+        # the expression matrix of each group, read once and reused by all its pairs
+        values = [eSet.subset(samples=eSet.samples[i], view=True).exprs.values for i in members]
+    # tidy output
+    out = []
+    for i, j in combinations(range(k), 2):
+        row = [groups[i], groups[j], snr[i, j]]
+        if permute > 0:
+            row.append(tsnr_pval(values[i], values[j], permute=permute, **kwargs))
+        out.append(row)
+    columns = ['Group1', 'Group2', 'tSNR'] + (['PValue'] if permute > 0 else [])
+    return pd.DataFrame(out, columns=columns)
 
 def tsnr_boot(X, Y, N=30, boot=1000):
     """Estimate the tSNR via bootstrapping (resampling with replacement)